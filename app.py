@@ -1,7 +1,20 @@
 from flask import Flask, request, g
 from config import Config
 from extensions import db, login_manager, csrf
-from models import RequestLog
+from request_logger import request_log_writer
+from view_counter import view_counter
+from avatars import avatar_processor
+from attachments import attachment_storage
+from thumbnails import thumbnail_generator
+from assets import asset_pipeline
+from compression import response_compressor
+import database
+import rendering
+import stats
+import user_cache
+from search_index import search_engine
+import commands
+from datetime import datetime
 import time
 import os
 
@@ -18,17 +31,26 @@ def create_app():
     )
     
     # 初始化扩展
-    db.init_app(app)
+    database.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
     login_manager.login_view = 'main.login'
     login_manager.login_message = '请先登录以访问此页面。'
+    rendering.init_app(app)
+    stats.init_app(app)
+    user_cache.init_app(app)
+    search_engine.init_app(app)
+    request_log_writer.init_app(app)
+    view_counter.init_app(app)
+    avatar_processor.init_app(app)
+    attachment_storage.init_app(app)
+    thumbnail_generator.init_app(app)
+    asset_pipeline.init_app(app)
+    response_compressor.init_app(app)
+    commands.init_app(app)
     
-    # 用户加载回调
-    @login_manager.user_loader
-    def load_user(user_id):
-        from models import User
-        return User.query.get(int(user_id))
+    # 用户加载回调，使用缓存的用户快照
+    login_manager.user_loader(user_cache.load_user)
     
     # 请求开始前记录时间
     @app.before_request
@@ -67,26 +89,24 @@ def create_app():
         elif hasattr(g, 'user_id'):
             user_id = g.user_id
         
-        # 创建请求日志记录
-        log_entry = RequestLog(
+        # 静态资源请求不记录日志
+        if request.endpoint in ('static', 'asset'):
+            return response
+        
+        # 创建请求日志记录，交给后台线程批量写入，不占用请求的数据库会话
+        request_log_writer.submit(dict(
             ip_address=request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr),
             user_agent=request.headers.get('User-Agent', ''),
             method=request.method,
             url=request.url,
+            endpoint=request.endpoint or '',
             status_code=response.status_code,
             response_time=response_time,
+            timestamp=datetime.utcnow(),
             user_id=user_id,
             referrer=request.headers.get('Referer', ''),
             content_length=request.content_length or 0
-        )
-        
-        try:
-            db.session.add(log_entry)
-            db.session.commit()
-        except Exception as e:
-            # 如果日志记录失败，回滚并继续
-            db.session.rollback()
-            print(f"日志记录失败: {str(e)}")
+        ))
         
         # 极端扩展日志记录（仅在调试模式下）
         if app.config.get('DEBUG_EXTREME_LOGGING', False):
@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+# 需要构建的静态资源，路径相对于static目录
+ASSET_SOURCES = ('css/style.css', 'js/script.js')
+
+_CSS_STRING_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    parts = _CSS_STRING_RE.split(text)
+    # 奇数位置是字符串，保持原样
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'\s+', ' ', parts[i])
+        part = re.sub(r'\s*([{};,>])\s*', r'\1', part)
+        parts[i] = re.sub(r':\s+', ':', part)
+    return ''.join(parts).replace(';}', '}').strip()
+
+def minify_js(text):
+    # 正则无法区分模板字符串、多行字符串和正则表达式字面量，安装rjsmin时才压缩，否则保持原样，只生成哈希文件名和预压缩文件
+    if rjsmin is None:
+        return text
+    return rjsmin.jsmin(text)
+
+_MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+class AssetPipeline:
+    """构建带内容哈希文件名的CSS/JS（附带.gz/.br预压缩文件），模板通过asset_url引用，
+    发送时按Accept-Encoding选择预压缩文件，并允许浏览器永久缓存"""
+
+    def __init__(self):
+        self.folder = None
+        self.source_folder = None
+        self.max_age = 365 * 86400
+        self.manifest = {}
+
+    def init_app(self, app):
+        self.source_folder = app.static_folder
+        self.folder = os.path.join(app.static_folder, 'dist')
+        self.max_age = app.config.get('ASSET_MAX_AGE', 365 * 86400)
+        self.manifest = self.load_manifest()
+        app.add_url_rule('/assets/<path:filename>', 'asset', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.folder, 'manifest.json')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def url(self, filename):
+        """模板中引用静态资源；尚未构建时使用原始文件"""
+        built = self.manifest.get(filename)
+        if built is None:
+            return url_for('static', filename=filename)
+        return url_for('asset', filename=built)
+
+    def build(self):
+        """压缩并写入带哈希的文件和预压缩文件，返回新的manifest；
+        上一次构建的文件保留，已打开的旧页面仍然可以加载"""
+        previous = self.load_manifest()
+        manifest = {}
+        for source in ASSET_SOURCES:
+            with open(os.path.join(self.source_folder, source), encoding='utf-8') as f:
+                text = f.read()
+            base, ext = os.path.splitext(source)
+            data = _MINIFIERS[ext](text).encode('utf-8')
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            built = f'{base}.{digest}{ext}'
+            path = os.path.join(self.folder, built)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, data)
+            # mtime固定为0，相同内容每次构建得到相同的文件
+            self._write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                self._write(path + '.br', brotli.compress(data, quality=11))
+            manifest[source] = built
+
+        self._write(self.manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+        self._remove_stale(set(manifest.values()) | set(previous.values()))
+        self.manifest = manifest
+        return manifest
+
+    def _write(self, path, data):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _remove_stale(self, keep):
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                built = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                for suffix in ('.gz', '.br'):
+                    if built.endswith(suffix):
+                        built = built[:-len(suffix)]
+                if built != 'manifest.json' and built not in keep:
+                    os.remove(path)
+
+    def serve(self, filename):
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+
+        response = send_file(path, mimetype=mimetype, max_age=self.max_age)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        # 文件名包含内容哈希，内容变化后地址也会变化
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        return response
+
+asset_pipeline = AssetPipeline()
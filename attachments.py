@@ -0,0 +1,376 @@
+import hashlib
+import os
+import tempfile
+import time
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.utils import secure_filename, send_file
+from extensions import db
+from models import Post, Attachment, AttachmentBlob
+
+CHUNK_SIZE = 64 * 1024
+# 附件发送方式：direct由应用发送，x-accel-redirect交给nginx，x-sendfile交给Apache/lighttpd
+DELIVERY_MODES = ('direct', 'x-accel-redirect', 'x-sendfile')
+
+# 按文件头判断类型，收到前SNIFF_SIZE字节后检查
+SNIFF_SIZE = 512
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (b'ID3', 'audio/mpeg'),
+    (b'OggS', 'audio/ogg'),
+    (b'MZ', 'application/x-msdownload'),
+    (b'\x7fELF', 'application/x-executable'),
+]
+
+def sniff_mimetype(head):
+    """根据文件开头的字节判断文件类型"""
+    for signature, mimetype in _SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+    if b'\x00' not in head:
+        try:
+            # 末尾可能截断了一个多字节字符
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError as e:
+            if e.start >= len(head) - 3:
+                return 'text/plain'
+    return 'application/octet-stream'
+
+class UploadStream:
+    """接收上传文件的临时文件，写入时累计大小、计算SHA-256并检查文件头，
+    超过大小限制或类型不允许时立即停止接收并删除临时文件"""
+
+    def __init__(self, folder, max_size=None, blocked_types=()):
+        os.makedirs(folder, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=folder)
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self.max_size = max_size
+        self.blocked_types = blocked_types
+        self.size = 0
+        self.mimetype = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(f'文件大小不能超过{self.max_size // (1024 * 1024)}MB')
+        if self.mimetype is None:
+            self._head += data[:SNIFF_SIZE - len(self._head)]
+            if len(self._head) >= SNIFF_SIZE:
+                self._sniff()
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def _sniff(self):
+        if self.mimetype is not None:
+            return
+        self.mimetype = sniff_mimetype(self._head)
+        self._head = b''
+        if self.mimetype in self.blocked_types:
+            self.close()
+            raise UnsupportedMediaType(f'不允许上传该类型的文件（{self.mimetype}）')
+
+    def seek(self, *args):
+        # 表单解析完成后会回到文件开头，此时文件可能不足SNIFF_SIZE字节
+        self._sniff()
+        return self._file.seek(*args)
+
+    @property
+    def content_hash(self):
+        return self._digest.hexdigest()
+
+    def claim(self):
+        """关闭并交出临时文件，之后由调用方负责移动或删除"""
+        self._sniff()
+        self._file.close()
+        path, self.path = self.path, None
+        return path
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+def streams_attachments(view):
+    """标记接收附件的视图：表单中的文件直接写入UploadStream，不再先缓存在内存或系统临时目录，
+    并在接收时检查附件的大小和类型；其他视图（如上传头像）的表单仍按默认方式解析"""
+    view.streams_attachments = True
+    return view
+
+def _get_file_stream(total_content_length, content_type, filename=None, content_length=None):
+    return attachment_storage.open_upload()
+
+class AttachmentStorage:
+    """按内容的SHA-256保存附件，文件位于 attachments/ab/cd/<hash>，内容相同的附件只保存一份，
+    AttachmentBlob.ref_count记录引用数，没有附件引用的文件才会被删除"""
+
+    def __init__(self):
+        self.root = None
+        self.max_size = 10 * 1024 * 1024
+        self.blocked_types = frozenset()
+        self.delivery = 'direct'
+        self.accel_prefix = '/internal-uploads/'
+
+    def init_app(self, app):
+        self.root = app.config.get('UPLOAD_FOLDER', os.path.join(app.root_path, 'uploads'))
+        self.max_size = app.config.get('ATTACHMENT_MAX_SIZE', 10 * 1024 * 1024)
+        self.blocked_types = frozenset(app.config.get('ATTACHMENT_BLOCKED_TYPES', ()))
+        self.delivery = app.config.get('ATTACHMENT_DELIVERY', 'direct')
+        if self.delivery not in DELIVERY_MODES:
+            raise ValueError(f'未知的附件发送方式: {self.delivery}')
+        self.accel_prefix = app.config.get('ATTACHMENT_ACCEL_PREFIX', '/internal-uploads/').rstrip('/') + '/'
+        # CSRF检查会在before_request中解析表单，需要在它之前替换文件流
+        app.before_request_funcs.setdefault(None, []).insert(0, _use_upload_stream)
+
+        # 文件在事务提交后才移入存储，回滚时删除
+        if not event.contains(db.session, 'after_commit', _place_staged_files):
+            event.listen(db.session, 'after_commit', _place_staged_files)
+            event.listen(db.session, 'after_transaction_end', _discard_staged_files)
+
+    def open_upload(self):
+        return UploadStream(self.temp_folder, self.max_size, self.blocked_types)
+
+    @property
+    def blob_folder(self):
+        return os.path.join(self.root, 'attachments')
+
+    @property
+    def temp_folder(self):
+        return os.path.join(self.root, 'tmp')
+
+    def relative_path(self, content_hash):
+        return '/'.join(('attachments', content_hash[:2], content_hash[2:4], content_hash))
+
+    def path(self, attachment):
+        """附件在磁盘上的路径；旧版本保存的是绝对路径，join后保持不变"""
+        return os.path.join(self.root, attachment.file_path)
+
+    def send(self, attachment):
+        """返回下载附件的响应，权限检查由调用方完成。
+        ETag使用内容哈希，客户端缓存未变化时返回304；direct方式支持Range断点续传，
+        其他方式只返回响应头，文件和Range请求由前端代理处理，不占用工作线程"""
+        path = self.path(attachment)
+        # 旧版本的附件没有内容哈希，由send_file根据文件信息生成ETag
+        etag = attachment.content_hash or True
+        offload = self.delivery != 'direct' and (self.delivery == 'x-sendfile' or attachment.content_hash is not None)
+        # Flask的send_file只能按全局配置USE_X_SENDFILE选择，这里直接使用werkzeug的实现
+        response = send_file(path, request.environ, as_attachment=True, download_name=attachment.filename,
+                             etag=etag, conditional=not offload, use_x_sendfile=offload,
+                             response_class=current_app.response_class)
+        response.cache_control.private = True
+        if not offload:
+            return response
+
+        # Range交给代理处理，这里只处理If-None-Match/If-Modified-Since
+        response = response.make_conditional(request)
+        sendfile_path = response.headers.pop('X-Sendfile', None)
+        if response.status_code == 304:
+            return response
+        if self.delivery == 'x-accel-redirect':
+            # nginx按内部location读取文件，路径相对于UPLOAD_FOLDER
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + attachment.file_path
+        else:
+            response.headers['X-Sendfile'] = sendfile_path
+        return response
+
+    def save(self, file, post_id, user_id):
+        """登记上传的文件，返回已加入会话的Attachment，文件在事务提交后移入存储。
+        表单中的文件在接收时已检查过大小和类型，其他来源的文件在这里检查，
+        不符合时抛出RequestEntityTooLarge或UnsupportedMediaType"""
+        upload = file.stream if isinstance(file.stream, UploadStream) else self._copy(file.stream, self.open_upload())
+        content_hash, size, mimetype = upload.content_hash, upload.size, upload.mimetype
+        self._stage(upload.claim(), content_hash, size)
+
+        attachment = Attachment(
+            filename=secure_filename(file.filename),
+            file_path=self.relative_path(content_hash),
+            file_size=size,
+            file_type=mimetype,
+            content_hash=content_hash,
+            post_id=post_id,
+            user_id=user_id
+        )
+        db.session.add(attachment)
+        return attachment
+
+    def _copy(self, stream, upload):
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            upload.write(chunk)
+        upload.seek(0)
+        return upload
+
+    def _stage(self, temp_path, content_hash, size):
+        # 先在事务中登记引用，提交后再放置文件，与collect删除文件的顺序相反，两者不会互相覆盖
+        staged = db.session.info.setdefault('staged_attachment_files', [])
+        staged.append((temp_path, content_hash))
+        self._add_reference(content_hash, size)
+
+    def _add_reference(self, content_hash, size, count=1):
+        table = AttachmentBlob.__table__
+        increment = table.update().where(table.c.hash == content_hash).values(ref_count=table.c.ref_count + count)
+        if db.session.execute(increment).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(AttachmentBlob(hash=content_hash, size=size, ref_count=count))
+        except IntegrityError:
+            # 其他请求同时上传了相同的文件
+            db.session.execute(increment)
+
+    def _place(self, temp_path, content_hash):
+        path = os.path.join(self.root, self.relative_path(content_hash))
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def release(self, *criteria):
+        """删除符合条件的附件记录并减少引用数，返回涉及的哈希；提交后调用collect删除无引用的文件"""
+        query = db.session.query(Attachment).filter(*criteria)
+        counts = query.with_entities(Attachment.content_hash, db.func.count(Attachment.id)).filter(
+            Attachment.content_hash.isnot(None)
+        ).group_by(Attachment.content_hash).all()
+        table = AttachmentBlob.__table__
+        for content_hash, count in counts:
+            db.session.execute(table.update().where(table.c.hash == content_hash).values(
+                ref_count=table.c.ref_count - count
+            ))
+        query.delete(synchronize_session=False)
+        return [content_hash for content_hash, count in counts]
+
+    def collect(self, hashes):
+        """删除引用数为0的文件；记录和文件在同一事务中删除，同时上传相同文件的请求会等待该事务结束"""
+        from thumbnails import thumbnail_generator
+        table = AttachmentBlob.__table__
+        removed = 0
+        for content_hash in hashes:
+            with db.engine.begin() as conn:
+                deleted = conn.execute(table.delete().where(
+                    table.c.hash == content_hash, table.c.ref_count <= 0
+                )).rowcount
+                if deleted:
+                    self._remove_file(self.relative_path(content_hash))
+                    removed += 1
+            if deleted:
+                thumbnail_generator.remove(content_hash)
+        return removed
+
+    def _remove_file(self, relative_path):
+        try:
+            os.remove(os.path.join(self.root, relative_path))
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self, grace_seconds=3600):
+        """清理孤立的附件记录和文件，返回各项清理数量。
+        最近grace_seconds秒内写入的文件可能属于尚未提交的上传，不会删除"""
+        # 旧版本删除用户时没有删除附件，帖子已不存在的附件记录视为孤立
+        orphaned = ~db.session.query(Post.id).filter(Post.id == Attachment.post_id).exists()
+        orphans = Attachment.query.filter(orphaned).count()
+        self.release(orphaned)
+        # 按附件表重新计算引用数，修正中途失败留下的误差
+        table = AttachmentBlob.__table__
+        references = db.session.query(db.func.count(Attachment.id)).filter(
+            Attachment.content_hash == table.c.hash
+        ).scalar_subquery()
+        db.session.execute(table.update().values(ref_count=references))
+        db.session.commit()
+
+        unreferenced = [row.hash for row in db.session.query(AttachmentBlob.hash).filter(AttachmentBlob.ref_count <= 0)]
+        blobs = self.collect(unreferenced)
+
+        # 删除没有记录的文件和残留的临时文件
+        known = {row.hash for row in db.session.query(AttachmentBlob.hash)}
+        cutoff = time.time() - grace_seconds
+        stray = 0
+        for folder in (self.blob_folder, self.temp_folder):
+            for dirpath, dirnames, filenames in os.walk(folder):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if folder == self.blob_folder and name in known:
+                        continue
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        stray += 1
+        return {'orphans': orphans, 'blobs': blobs, 'stray_files': stray}
+
+    def import_legacy(self):
+        """把旧版本按文件名平铺保存的附件移入按内容保存的目录，返回导入的附件数"""
+        attachments = Attachment.query.filter(Attachment.content_hash.is_(None)).all()
+        imported = []
+        for attachment in attachments:
+            source = self.path(attachment)
+            if not os.path.isfile(source):
+                continue
+            with open(source, 'rb') as stream:
+                upload = self._copy(stream, UploadStream(self.temp_folder))
+            attachment.content_hash = upload.content_hash
+            attachment.file_path = self.relative_path(upload.content_hash)
+            attachment.file_size = upload.size
+            self._stage(upload.claim(), upload.content_hash, upload.size)
+            imported.append(source)
+        db.session.commit()
+
+        # 提交后再删除原文件，同名文件可能被多条记录引用
+        for source in set(imported):
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+        return len(imported)
+
+attachment_storage = AttachmentStorage()
+
+def _use_upload_stream():
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'streams_attachments', False):
+        request._get_file_stream = _get_file_stream
+
+def _place_staged_files(session):
+    # 释放保存点时也会触发after_commit，只处理顶层事务的提交
+    if session.in_nested_transaction():
+        return
+    for temp_path, content_hash in session.info.pop('staged_attachment_files', []):
+        try:
+            attachment_storage._place(temp_path, content_hash)
+        except OSError as e:
+            # 已提交的附件缺少文件，临时文件留给gc-attachments清理
+            print(f"附件文件保存失败: {content_hash}: {str(e)}")
+
+def _discard_staged_files(session, transaction):
+    # 顶层事务结束（回滚或关闭会话）时仍未放置的文件属于未提交的附件
+    if transaction.parent is not None:
+        return
+    for temp_path, content_hash in session.info.pop('staged_attachment_files', []):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,198 @@
+import atexit
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import url_for
+from cache import LRUCache
+
+# 生成的头像尺寸（正方形边长，像素）
+AVATAR_SIZES = (32, 64, 128, 512)
+# 记录各头像文件状态的数量上限
+STATE_CACHE_SIZE = 10000
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+# 原格式变体的保存格式，GIF和BMP转为PNG
+_ORIGINAL_FORMATS = {
+    'png': ('PNG', 'png'),
+    'jpg': ('JPEG', 'jpg'),
+    'jpeg': ('JPEG', 'jpg'),
+    'gif': ('PNG', 'png'),
+    'bmp': ('PNG', 'png'),
+}
+
+def _variant_ext(ext, image_format):
+    return 'webp' if image_format == 'webp' else _ORIGINAL_FORMATS[ext][1]
+
+class AvatarProcessor:
+    """上传的头像先原样保存，由线程池裁剪缩放为多种尺寸的WebP和原格式图片，请求不等待处理完成"""
+
+    def __init__(self):
+        self.folder = None
+        self.workers = 2
+        self.image_format = 'webp'
+        self.processed = 0
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        # 头像名 -> 文件状态，渲染页面时不再逐个检查文件是否存在
+        self._states = LRUCache(maxsize=STATE_CACHE_SIZE)
+
+    def init_app(self, app):
+        # 头像保存在static下，由静态文件服务直接提供
+        self.folder = os.path.join(app.static_folder, 'uploads', 'avatars')
+        self.workers = app.config.get('AVATAR_WORKERS', 2)
+        self.image_format = app.config.get('AVATAR_FORMAT', 'webp')
+        app.add_template_global(self.url, 'avatar_url')
+
+        if self.workers > 0 and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='avatar')
+            # 进程退出前处理完已提交的头像
+            atexit.register(self.shutdown)
+
+    def save_upload(self, file, owner):
+        """保存上传的头像并提交处理，返回写入User.avatar的值；格式不支持或不是图片时抛出ValueError"""
+        ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+        if ext not in ALLOWED_EXTENSIONS:
+            raise ValueError('头像文件格式不支持，仅支持 PNG, JPG, JPEG, GIF, BMP 格式')
+
+        from PIL import Image, UnidentifiedImageError
+        # 只检查文件头，不解码图片
+        try:
+            with Image.open(file.stream) as image:
+                image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            raise ValueError('头像文件不是有效的图片')
+        file.stream.seek(0)
+
+        # 文件名带随机版本号，更换头像后浏览器不会使用旧的缓存
+        name = f'{owner}-{uuid.uuid4().hex[:8]}'
+        os.makedirs(self.folder, exist_ok=True)
+        file.save(os.path.join(self.folder, f'{name}.{ext}'))
+
+        with self._lock:
+            self._pending.add(name)
+        if self._executor is not None:
+            self._executor.submit(self._process, name, ext)
+        else:
+            self._process(name, ext)
+        return f'avatars/{name}.{ext}'
+
+    def reprocess(self, avatar):
+        """根据保存的原图重新生成各尺寸（修改尺寸或格式后使用），在当前线程中处理"""
+        name, ext = avatar[len('avatars/'):].rsplit('.', 1)
+        self._process(name, ext)
+
+    def import_file(self, path, owner):
+        """导入旧版本保存的单个头像文件，返回新的User.avatar值"""
+        ext = path.rsplit('.', 1)[1].lower()
+        name = f'{owner}-{uuid.uuid4().hex[:8]}'
+        os.makedirs(self.folder, exist_ok=True)
+        shutil.copyfile(path, os.path.join(self.folder, f'{name}.{ext}'))
+        self._process(name, ext)
+        return f'avatars/{name}.{ext}'
+
+    def is_pending(self, name):
+        with self._lock:
+            return name in self._pending
+
+    def _process(self, name, ext):
+        from PIL import Image, ImageOps
+        try:
+            with Image.open(os.path.join(self.folder, f'{name}.{ext}')) as image:
+                # JPEG按目标尺寸缩小解码，减少解码大图的开销
+                image.draft('RGB', (AVATAR_SIZES[-1], AVATAR_SIZES[-1]))
+                image = ImageOps.exif_transpose(image)
+                has_alpha = image.mode in ('RGBA', 'LA', 'P')
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+
+            # 保持比例，从中间裁剪为正方形，再依次缩小
+            side = min(AVATAR_SIZES[-1], image.width, image.height)
+            square = ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+            for size in reversed(AVATAR_SIZES):
+                variant = square if size >= side else square.resize((size, size), Image.Resampling.LANCZOS)
+                self._save(variant, name, size, 'WEBP', 'webp', quality=80, method=4)
+                image_format, variant_ext = _ORIGINAL_FORMATS[ext]
+                if image_format == 'JPEG' and has_alpha:
+                    background = Image.new('RGB', variant.size, (255, 255, 255))
+                    background.paste(variant, mask=variant.getchannel('A'))
+                    variant = background
+                self._save(variant, name, size, image_format, variant_ext, optimize=True)
+            self._states.set(name, 'variants')
+            self.processed += 1
+        except Exception as e:
+            print(f"头像处理失败: {name}: {str(e)}")
+            self._states.set(name, self._check(name, ext))
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _save(self, image, name, size, image_format, ext, **options):
+        # 先写临时文件再重命名，不会读到写了一半的图片
+        path = os.path.join(self.folder, f'{name}-{size}.{ext}')
+        temp_path = f'{path}.tmp'
+        image.save(temp_path, image_format, **options)
+        os.replace(temp_path, path)
+
+    def remove(self, avatar):
+        """删除头像的原图和所有尺寸"""
+        if not avatar or not avatar.startswith('avatars/'):
+            return
+        name, ext = avatar[len('avatars/'):].rsplit('.', 1)
+        self._states.delete(name)
+        paths = [f'{name}.{ext}']
+        for size in AVATAR_SIZES:
+            paths.append(f'{name}-{size}.webp')
+            paths.append(f'{name}-{size}.{_ORIGINAL_FORMATS[ext][1]}')
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.folder, path))
+            except FileNotFoundError:
+                pass
+
+    def _check(self, name, ext):
+        """检查磁盘上的文件：variants 已生成各尺寸，original 只有上传的原图，missing 原图也不存在"""
+        # 最小尺寸最后生成，存在时其他尺寸都已生成
+        variant = f'{name}-{AVATAR_SIZES[0]}.{_variant_ext(ext, self.image_format)}'
+        if os.path.isfile(os.path.join(self.folder, variant)):
+            return 'variants'
+        if os.path.isfile(os.path.join(self.folder, f'{name}.{ext}')):
+            return 'original'
+        return 'missing'
+
+    def _state(self, name, ext):
+        state = self._states.get(name)
+        if state is None:
+            # 处理结果未记录在本进程中（如重启后），检查一次文件；其他进程可能仍在处理，只记录已生成的结果
+            state = self._check(name, ext)
+            if state == 'variants':
+                self._states.set(name, state)
+        return state
+
+    def url(self, user, size=64):
+        """模板中使用的头像地址，选择不小于size的最小尺寸；处理完成前使用上传的原图"""
+        avatar = user.avatar
+        if not avatar or avatar == 'default.jpg':
+            return url_for('static', filename='images/default-avatar.svg')
+        if not avatar.startswith('avatars/'):
+            # 旧版本上传的头像只有一个文件
+            return url_for('static', filename='uploads/' + avatar)
+        name, ext = avatar[len('avatars/'):].rsplit('.', 1)
+        if self.is_pending(name):
+            return url_for('static', filename='uploads/' + avatar)
+        state = self._state(name, ext)
+        if state != 'variants':
+            # 处理失败（例如文件被截断）时没有生成各尺寸，使用上传的原图；原图也不存在时使用默认头像
+            if state == 'missing':
+                return url_for('static', filename='images/default-avatar.svg')
+            return url_for('static', filename='uploads/' + avatar)
+        size = next((candidate for candidate in AVATAR_SIZES if candidate >= size), AVATAR_SIZES[-1])
+        variant = f'{name}-{size}.{_variant_ext(ext, self.image_format)}'
+        return url_for('static', filename=f'uploads/avatars/{variant}')
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+avatar_processor = AvatarProcessor()
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """线程安全的进程内LRU缓存"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            # 超出容量时淘汰最久未使用的条目
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache:
+    """带过期时间的进程内缓存。过期后只有一个线程调用loader重新加载，
+    其余线程在有旧值时直接返回旧值，没有旧值时等待加载完成；
+    设置maxsize时超出容量淘汰最久未使用的条目"""
+
+    def __init__(self, ttl=60, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        if entry is not None:
+            if not load_lock.acquire(blocking=False):
+                # 其他线程正在刷新，先返回旧值
+                return entry[0]
+        else:
+            load_lock.acquire()
+        try:
+            with self._lock:
+                current = self._data.get(key)
+            if current is not None and current[1] > time.monotonic() and current is not entry:
+                # 等待期间其他线程已经加载完成
+                return current[0]
+            value = loader()
+            with self._lock:
+                self._data[key] = (value, time.monotonic() + self.ttl)
+                self._data.move_to_end(key)
+                while self.maxsize is not None and len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+            return value
+        finally:
+            # 加载结束后移除锁，按用户等大量键缓存时不会一直保留
+            with self._lock:
+                if self._loading.get(key) is load_lock:
+                    del self._loading[key]
+            load_lock.release()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,223 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask.cli import with_appcontext
+from extensions import db
+from models import User, Post, Comment
+from rendering import content_hash, render_batch
+
+def init_app(app):
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(rerender_content_command)
+    app.cli.add_command(recount_counters_command)
+    app.cli.add_command(rollup_request_logs_command)
+    app.cli.add_command(rollup_daily_stats_command)
+    app.cli.add_command(prune_request_logs_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(process_avatars_command)
+    app.cli.add_command(gc_attachments_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(check_query_plans_command)
+
+# 升级已存在的数据库结构
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    from migrations import upgrade_schema
+    added = upgrade_schema()
+    for column in added:
+        click.echo(f'已添加: {column}')
+    from migrations import apply_migrations
+    for name in apply_migrations():
+        click.echo(f'已执行迁移: {name}')
+    click.echo('数据库结构已是最新')
+
+def _chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def rerender_model(model, executor=None, workers=1, batch_size=200, force=False):
+    table = model.__table__
+    # 保持updated_at不变，重新渲染不算作编辑
+    values = {
+        'content_html': db.bindparam('b_html'),
+        'content_hash': db.bindparam('b_hash'),
+        'content_preview': db.bindparam('b_preview'),
+    }
+    if 'updated_at' in table.c:
+        values['updated_at'] = table.c.updated_at
+    stmt = table.update().where(table.c.id == db.bindparam('b_id')).values(**values)
+
+    rendered = 0
+    last_id = None
+    while True:
+        # 按主键分批读取，避免一次性加载全部内容
+        query = db.session.query(
+            model.id, model.content, model.content_hash, model.content_preview.is_(None).label('missing_preview')
+        ).order_by(model.id)
+        if last_id is not None:
+            query = query.filter(model.id > last_id)
+        rows = query.limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        stale = [
+            row for row in rows
+            if force or row.missing_preview or row.content_hash != content_hash(row.content)
+        ]
+        if stale:
+            texts = [row.content for row in stale]
+            if executor is not None:
+                results = [item for part in executor.map(render_batch, _chunks(texts, workers)) for item in part]
+            else:
+                results = render_batch(texts)
+
+            db.session.execute(stmt, [
+                {'b_id': row.id, 'b_hash': digest, 'b_html': html, 'b_preview': preview}
+                for row, (digest, html, preview) in zip(stale, results)
+            ])
+            db.session.commit()
+            rendered += len(stale)
+
+    return rendered
+
+# 重新渲染所有帖子和评论的Markdown和预览（修改渲染器或扩展后运行）
+@click.command('rerender-content')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='并行渲染的进程数')
+@click.option('--batch-size', default=200, show_default=True, help='每批处理的记录数')
+@click.option('--force', is_flag=True, help='忽略内容哈希，全部重新渲染')
+@with_appcontext
+def rerender_content_command(workers, batch_size, force):
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for model in (Post, Comment):
+            rendered = rerender_model(model, executor, workers, batch_size, force)
+            click.echo(f'{model.__name__}: 已重新渲染 {rendered} 条')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+# 按评论表和投票表重新计算帖子和评论的计数列
+@click.command('recount-counters')
+@with_appcontext
+def recount_counters_command():
+    import counters
+    posts = counters.recount_posts()
+    comments = counters.recount_comments()
+    db.session.commit()
+    click.echo(f'已重新计算 {posts} 个帖子和 {comments} 条评论的计数')
+
+# 把已结束的小时内的请求日志汇总到汇总表（建议每小时由cron运行一次）
+@click.command('rollup-request-logs')
+@with_appcontext
+def rollup_request_logs_command():
+    from log_rollups import rollup_request_logs
+    processed = rollup_request_logs()
+    click.echo(f'已汇总 {processed} 条请求日志')
+
+# 统计上次之后每天的新增用户、帖子、评论等数据（建议每小时由cron运行一次）
+@click.command('rollup-daily-stats')
+@with_appcontext
+def rollup_daily_stats_command():
+    from daily_stats import rollup_daily_stats
+    days = rollup_daily_stats()
+    click.echo(f'已统计 {days} 天的数据')
+
+# 删除超过保留天数且已汇总的原始请求日志
+@click.command('prune-request-logs')
+@click.option('--days', type=click.IntRange(min=1), default=None, help='保留天数（至少1天），默认使用REQUEST_LOG_RETENTION_DAYS')
+@click.option('--batch-size', default=5000, show_default=True, help='每批删除的记录数')
+@with_appcontext
+def prune_request_logs_command(days, batch_size):
+    from flask import current_app
+    from log_rollups import rollup_request_logs, prune_request_logs
+    if days is None:
+        days = current_app.config.get('REQUEST_LOG_RETENTION_DAYS', 30)
+        if days < 1:
+            raise click.BadParameter('REQUEST_LOG_RETENTION_DAYS 至少为1', param_hint='--days')
+    # 先汇总，保证删除的日志都已计入汇总表
+    rollup_request_logs()
+    deleted = prune_request_logs(days, batch_size)
+    click.echo(f'已删除 {deleted} 条 {days} 天前的请求日志')
+
+# 重建帖子和用户的全文索引（首次启用搜索索引或索引损坏时运行）
+@click.command('rebuild-search-index')
+@click.option('--batch-size', default=500, show_default=True, help='每批处理的记录数')
+@with_appcontext
+def rebuild_search_index_command(batch_size):
+    from search_index import search_engine
+    counts = search_engine.rebuild(batch_size)
+    db.session.commit()
+    click.echo(f'搜索后端: {search_engine.backend.name}')
+    for name, count in counts.items():
+        click.echo(f'{name}: 已索引 {count} 条')
+
+# 重新生成所有头像的各个尺寸，并导入旧版本保存的单文件头像
+@click.command('process-avatars')
+@with_appcontext
+def process_avatars_command():
+    from flask import current_app
+    from avatars import avatar_processor, ALLOWED_EXTENSIONS
+    processed = imported = missing = 0
+    users = User.query.filter(User.avatar.isnot(None), User.avatar != 'default.jpg').all()
+    for user in users:
+        if user.avatar.startswith('avatars/'):
+            avatar_processor.reprocess(user.avatar)
+            processed += 1
+            continue
+        # 旧版本的头像保存在UPLOAD_FOLDER，模板中按static/uploads引用
+        candidates = [
+            os.path.join(current_app.config['UPLOAD_FOLDER'], user.avatar),
+            os.path.join(current_app.static_folder, 'uploads', user.avatar),
+        ]
+        path = next((candidate for candidate in candidates if os.path.isfile(candidate)), None)
+        if path is None or user.avatar.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+            missing += 1
+            continue
+        user.avatar = avatar_processor.import_file(path, user.user_id)
+        imported += 1
+    db.session.commit()
+    click.echo(f'已处理 {processed} 个头像，导入 {imported} 个旧头像，{missing} 个头像文件不存在')
+
+# 清理没有附件引用的文件、帖子已删除的附件记录和残留的临时文件
+@click.command('gc-attachments')
+@click.option('--grace-hours', default=1.0, show_default=True, help='不删除最近几小时内写入的文件，它们可能属于正在进行的上传')
+@with_appcontext
+def gc_attachments_command(grace_hours):
+    from attachments import attachment_storage
+    result = attachment_storage.collect_garbage(grace_seconds=grace_hours * 3600)
+    click.echo(f"已删除 {result['orphans']} 条孤立的附件记录，{result['blobs']} 个无引用的文件，{result['stray_files']} 个残留文件")
+
+# 压缩CSS/JS并生成带内容哈希的文件名和预压缩文件（修改static下的CSS/JS后运行，然后重启应用）
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    from assets import asset_pipeline, brotli
+    manifest = asset_pipeline.build()
+    for source, built in sorted(manifest.items()):
+        click.echo(f'{source} -> {built}')
+    if brotli is None:
+        click.echo('未安装brotli，只生成了.gz文件')
+
+# 检查高频查询的执行计划，出现全表扫描或未使用预期索引时以非0状态退出
+@click.command('check-query-plans')
+@click.option('--verbose', '-v', is_flag=True, help='输出每条查询的完整执行计划')
+@click.option('--current-db', is_flag=True, help='检查当前数据库，而不是内存中的示例数据库（结果受实际数据量和统计信息影响）')
+@with_appcontext
+def check_query_plans_command(verbose, current_db):
+    from query_plans import check_query_plans, check_fixture_query_plans
+    failed = 0
+    results = check_query_plans() if current_db else check_fixture_query_plans()
+    for check, plan, problems in results:
+        click.echo(f"{'FAIL' if problems else 'OK  '} {check.name}")
+        for problem in problems:
+            click.echo(f'     {problem}')
+        if verbose or problems:
+            for detail in plan:
+                click.echo(f'       | {detail}')
+        failed += bool(problems)
+    if failed:
+        click.echo(f'{failed} 条查询的执行计划不符合预期')
+        raise SystemExit(1)
+    click.echo('所有查询的执行计划符合预期')
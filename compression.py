@@ -0,0 +1,113 @@
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 压缩的响应类型，图片、附件等已压缩或直接发送文件的响应不处理
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/javascript', 'text/xml',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+}
+
+class _GzipStream:
+    def __init__(self, level):
+        # wbits=31 输出带gzip头的数据
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # 每块数据都立即输出，流式响应的内容可以尽快到达浏览器
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class _BrotliStream:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+class ResponseCompressor:
+    """按Accept-Encoding用brotli或gzip压缩HTML、JSON等文本响应，小于最小长度的响应、
+    已设置Content-Encoding的响应和send_file发送的文件不压缩"""
+
+    def __init__(self):
+        self.enabled = True
+        self.level = 6
+        self.brotli_quality = 5
+        self.min_size = 500
+        self.compressed = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_ENABLED', True)
+        self.level = app.config.get('COMPRESS_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', 5)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        if self.enabled:
+            app.after_request(self.compress_response)
+
+    def _choose_encoding(self):
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def _stream(self, encoding):
+        return _BrotliStream(self.brotli_quality) if encoding == 'br' else _GzipStream(self.level)
+
+    def compress_response(self, response):
+        if (response.mimetype not in COMPRESSIBLE_TYPES
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or 'no-transform' in response.headers.get('Cache-Control', '')
+                or request.method == 'HEAD'):
+            return response
+
+        # 是否压缩取决于Accept-Encoding，缓存需要区分
+        response.vary.add('Accept-Encoding')
+        encoding = self._choose_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._compress_iter(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            stream = self._stream(encoding)
+            response.set_data(stream.compress(data) + stream.finish())
+
+        response.headers['Content-Encoding'] = encoding
+        # 压缩后的字节与原内容不同，强ETag改为弱ETag
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        self.compressed += 1
+        return response
+
+    def _compress_iter(self, chunks, encoding):
+        stream = self._stream(encoding)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield stream.compress(chunk)
+            yield stream.finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+response_compressor = ResponseCompressor()
@@ -4,7 +4,51 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///forum.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 数据库连接配置方案：auto（SQLite使用sqlite-wal，其他数据库使用server）/sqlite-wal/sqlite-default/server
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'auto')
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    ATTACHMENT_MAX_SIZE = int(os.environ.get('ATTACHMENT_MAX_SIZE', 10 * 1024 * 1024))  # 单个附件的最大字节数
+    # 禁止上传的文件类型（按文件头判断），逗号分隔
+    ATTACHMENT_BLOCKED_TYPES = [t for t in os.environ.get('ATTACHMENT_BLOCKED_TYPES', 'application/x-msdownload,application/x-executable').split(',') if t]
+    # 同时生成图片附件缩略图的线程数、请求等待生成的最长秒数、浏览器缓存秒数
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+    THUMBNAIL_TIMEOUT = float(os.environ.get('THUMBNAIL_TIMEOUT', 30))
+    THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 30 * 86400))
+    # 附件发送方式：direct（应用发送）/x-accel-redirect（nginx）/x-sendfile（Apache/lighttpd）
+    ATTACHMENT_DELIVERY = os.environ.get('ATTACHMENT_DELIVERY', 'direct')
+    # x-accel-redirect方式下nginx中指向UPLOAD_FOLDER的internal location
+    ATTACHMENT_ACCEL_PREFIX = os.environ.get('ATTACHMENT_ACCEL_PREFIX', '/internal-uploads/')
     WTF_CSRF_ENABLED = True
     WTF_CSRF_TIME_LIMIT = None
+    MARKDOWN_CACHE_SIZE = int(os.environ.get('MARKDOWN_CACHE_SIZE', 512))  # Markdown渲染缓存条目数
+    # 请求日志后台写入配置
+    REQUEST_LOG_ASYNC = os.environ.get('REQUEST_LOG_ASYNC', '1') != '0'
+    REQUEST_LOG_QUEUE_SIZE = int(os.environ.get('REQUEST_LOG_QUEUE_SIZE', 10000))     # 队列最大长度
+    REQUEST_LOG_BATCH_SIZE = int(os.environ.get('REQUEST_LOG_BATCH_SIZE', 200))       # 每批写入条数
+    REQUEST_LOG_FLUSH_INTERVAL = float(os.environ.get('REQUEST_LOG_FLUSH_INTERVAL', 1.0))  # 最长等待秒数
+    REQUEST_LOG_DROP_POLICY = os.environ.get('REQUEST_LOG_DROP_POLICY', 'drop_new')   # 队列满时：drop_new/drop_oldest/block
+    # 原始请求日志保留天数，更早的日志只保留小时/天汇总
+    REQUEST_LOG_RETENTION_DAYS = int(os.environ.get('REQUEST_LOG_RETENTION_DAYS', 30))
+    # 帖子浏览量在内存中累计后批量写入的间隔秒数，设为0时每次浏览立即写入
+    VIEW_COUNT_FLUSH_INTERVAL = float(os.environ.get('VIEW_COUNT_FLUSH_INTERVAL', 5.0))
+    # 同一访客重复浏览同一帖子的去重窗口秒数，设为0时不去重
+    VIEW_COUNT_DEDUP_SECONDS = int(os.environ.get('VIEW_COUNT_DEDUP_SECONDS', 0))
+    # 登录用户信息的缓存秒数和每个进程最多缓存的用户数，修改或删除用户提交后本进程中立即失效
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+    # 处理头像的线程数，设为0时在请求中直接处理
+    AVATAR_WORKERS = int(os.environ.get('AVATAR_WORKERS', 2))
+    # 模板中使用的头像格式：webp 或 original（与上传格式相同，GIF/BMP为PNG）
+    AVATAR_FORMAT = os.environ.get('AVATAR_FORMAT', 'webp')
+    # HTML/JSON等文本响应的压缩：gzip压缩级别、brotli质量（安装brotli后启用）、不压缩的最小字节数
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') != '0'
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    # 构建后带哈希文件名的CSS/JS的浏览器缓存秒数
+    ASSET_MAX_AGE = int(os.environ.get('ASSET_MAX_AGE', 365 * 86400))
+    # 首页和后台统计数据的缓存秒数
+    SITE_STATS_TTL = int(os.environ.get('SITE_STATS_TTL', 60))
+    # 搜索后端：auto（优先SQLite FTS5，不可用时使用内存倒排索引）/fts5/memory
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
@@ -0,0 +1,76 @@
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import Message, Conversation
+
+PREVIEW_LENGTH = 100
+
+def _preview(content):
+    return (content or '')[:PREVIEW_LENGTH]
+
+def _get_or_create(user_id, partner_id):
+    query = Conversation.query.filter_by(user_id=user_id, partner_id=partner_id)
+    conversation = query.first()
+    if conversation is not None:
+        return conversation
+    try:
+        with db.session.begin_nested():
+            conversation = Conversation(user_id=user_id, partner_id=partner_id, unread_count=0)
+            db.session.add(conversation)
+    except IntegrityError:
+        # 双方同时第一次发送私信，对话已由另一个请求创建
+        conversation = query.one()
+    return conversation
+
+def record_message(message):
+    """发送私信后更新双方的对话摘要，需在message写入（flush）之后调用"""
+    if message.sender_id == message.recipient_id:
+        return
+    for user_id, partner_id in ((message.sender_id, message.recipient_id), (message.recipient_id, message.sender_id)):
+        conversation = _get_or_create(user_id, partner_id)
+        conversation.last_message_id = message.id
+        conversation.last_sender_id = message.sender_id
+        conversation.last_message_preview = _preview(message.content)
+        conversation.last_message_at = message.created_at
+        if user_id == message.recipient_id:
+            # 在SQL中累加，同时收到的多条私信不会互相覆盖未读数
+            db.session.execute(db.update(Conversation).where(Conversation.id == conversation.id).values(
+                unread_count=db.func.coalesce(Conversation.unread_count, 0) + 1
+            ).execution_options(synchronize_session=False))
+
+def mark_read(user_id, partner_id):
+    Conversation.query.filter_by(user_id=user_id, partner_id=partner_id).filter(
+        Conversation.unread_count != 0
+    ).update({Conversation.unread_count: 0}, synchronize_session=False)
+
+def remove_user(user_id):
+    # 删除用户时同时删除其他用户与该用户的对话
+    Conversation.query.filter(db.or_(
+        Conversation.user_id == user_id,
+        Conversation.partner_id == user_id
+    )).delete(synchronize_session=False)
+
+def rebuild(batch_size=1000):
+    """根据消息表重建所有对话摘要，返回对话数"""
+    summaries = {}
+    rows = db.session.query(
+        Message.id, Message.sender_id, Message.recipient_id, Message.content, Message.created_at, Message.is_read
+    ).order_by(Message.created_at, Message.id).yield_per(batch_size)
+    for row in rows:
+        if row.sender_id == row.recipient_id:
+            continue
+        for user_id, partner_id in ((row.sender_id, row.recipient_id), (row.recipient_id, row.sender_id)):
+            summary = summaries.setdefault((user_id, partner_id), {'user_id': user_id, 'partner_id': partner_id, 'unread_count': 0})
+            # 按时间顺序遍历，最后一次赋值即为最后一条消息
+            summary.update(
+                last_message_id=row.id,
+                last_sender_id=row.sender_id,
+                last_message_preview=_preview(row.content),
+                last_message_at=row.created_at,
+            )
+            if user_id == row.recipient_id and not row.is_read:
+                summary['unread_count'] += 1
+
+    Conversation.query.delete(synchronize_session=False)
+    if summaries:
+        db.session.execute(db.insert(Conversation), list(summaries.values()))
+    return len(summaries)
@@ -0,0 +1,58 @@
+from extensions import db
+from models import Post, Comment, Vote
+
+def _update(model, criterion, values):
+    # 计数变化不算作内容编辑，保持updated_at不变
+    if hasattr(model, 'updated_at'):
+        values[model.updated_at] = model.updated_at
+    stmt = db.update(model).where(criterion).values(values)
+    return db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+
+def increment_comment_count(post_id, delta=1):
+    _update(Post, Post.id == post_id, {Post.comment_count: Post.comment_count + delta})
+
+def apply_vote(model, entity_id, old_vote, new_vote):
+    # 根据投票前后的类型调整赞/踩计数，old_vote为0表示新投票
+    up_delta = (new_vote == 1) - (old_vote == 1)
+    down_delta = (new_vote == -1) - (old_vote == -1)
+
+    values = {}
+    if up_delta:
+        values[model.upvote_count] = model.upvote_count + up_delta
+    if down_delta:
+        values[model.downvote_count] = model.downvote_count + down_delta
+    if values:
+        _update(model, model.id == entity_id, values)
+
+def _vote_count(voted_type, entity_id, vote_type):
+    return db.select(db.func.count(Vote.id)).where(
+        Vote.voted_type == voted_type,
+        Vote.voted_id == entity_id,
+        Vote.vote_type == vote_type
+    ).scalar_subquery()
+
+def recount_posts(post_ids=None):
+    """重新计算帖子的评论数和赞/踩数，post_ids为None时处理全部帖子"""
+    if post_ids is not None and not post_ids:
+        return 0
+
+    comment_count = db.select(db.func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+    values = {
+        Post.comment_count: comment_count,
+        Post.upvote_count: _vote_count('post', Post.id, 1),
+        Post.downvote_count: _vote_count('post', Post.id, -1),
+    }
+    criterion = Post.id.in_(post_ids) if post_ids is not None else db.true()
+    return _update(Post, criterion, values)
+
+def recount_comments(comment_ids=None):
+    """重新计算评论的赞/踩数，comment_ids为None时处理全部评论"""
+    if comment_ids is not None and not comment_ids:
+        return 0
+
+    values = {
+        Comment.upvote_count: _vote_count('comment', Comment.id, 1),
+        Comment.downvote_count: _vote_count('comment', Comment.id, -1),
+    }
+    criterion = Comment.id.in_(comment_ids) if comment_ids is not None else db.true()
+    return _update(Comment, criterion, values)
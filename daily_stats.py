@@ -0,0 +1,129 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from extensions import db
+from models import User, Post, Comment, Vote, Message, DailyStats
+from log_rollups import get_checkpoint, set_checkpoint
+
+CHECKPOINT_NAME = 'daily_stats'
+SITE = 0
+COUNTERS = ('new_users', 'posts', 'comments', 'votes', 'messages', 'active_users')
+
+def _as_date(value):
+    # SQLite的date()返回字符串，其他数据库返回date
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+def _day(column):
+    return db.func.date(column).label('day')
+
+def _in_range(column, start, end):
+    return db.and_(column >= start, column < end)
+
+def compute_daily_stats(start, end):
+    """统计 [start, end) 内每天的数据，返回 {(日期, 版块ID): 各项计数}；
+    所有查询都按created_at范围过滤，耗时只与时间段内的数据量有关"""
+    stats = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def collect(field, rows):
+        for row in rows:
+            stats[(_as_date(row[0]), row[1])][field] += row[2]
+
+    collect('new_users', db.session.query(_day(User.created_at), db.literal(SITE), db.func.count(User.id)).filter(
+        _in_range(User.created_at, start, end)).group_by(db.text('day')))
+    collect('votes', db.session.query(_day(Vote.created_at), db.literal(SITE), db.func.count(Vote.id)).filter(
+        _in_range(Vote.created_at, start, end)).group_by(db.text('day')))
+    collect('messages', db.session.query(_day(Message.created_at), db.literal(SITE), db.func.count(Message.id)).filter(
+        _in_range(Message.created_at, start, end)).group_by(db.text('day')))
+
+    post_rows = db.session.query(_day(Post.created_at), Post.category_id, db.func.count(Post.id)).filter(
+        _in_range(Post.created_at, start, end)).group_by(db.text('day'), Post.category_id).all()
+    comment_rows = db.session.query(_day(Comment.created_at), Post.category_id, db.func.count(Comment.id)).join(
+        Post, Comment.post_id == Post.id).filter(
+        _in_range(Comment.created_at, start, end)).group_by(db.text('day'), Post.category_id).all()
+    # 版块行按版块统计，全站行为各版块之和
+    for field, rows in (('posts', post_rows), ('comments', comment_rows)):
+        collect(field, rows)
+        collect(field, [(row[0], SITE, row[2]) for row in rows])
+
+    # 活跃用户：当天发帖、评论、投票或发私信的不同用户数
+    category_actions = [
+        db.select(_day(Post.created_at), Post.category_id.label('category_id'), Post.user_id.label('user_id')).where(
+            _in_range(Post.created_at, start, end)),
+        db.select(_day(Comment.created_at), Post.category_id, Comment.user_id).join(
+            Post, Comment.post_id == Post.id).where(_in_range(Comment.created_at, start, end)),
+    ]
+    site_actions = [
+        db.select(_day(Post.created_at), db.literal(SITE).label('category_id'), Post.user_id.label('user_id')).where(
+            _in_range(Post.created_at, start, end)),
+        db.select(_day(Comment.created_at), db.literal(SITE), Comment.user_id).where(
+            _in_range(Comment.created_at, start, end)),
+        db.select(_day(Vote.created_at), db.literal(SITE), Vote.user_id).where(_in_range(Vote.created_at, start, end)),
+        db.select(_day(Message.created_at), db.literal(SITE), Message.sender_id).where(
+            _in_range(Message.created_at, start, end)),
+    ]
+    actions = db.union(*category_actions, *site_actions).subquery()
+    collect('active_users', db.session.execute(
+        db.select(actions.c.day, actions.c.category_id, db.func.count(db.distinct(actions.c.user_id)))
+        .group_by(actions.c.day, actions.c.category_id)
+    ))
+    return stats
+
+def _replace_daily_stats(start, end, stats):
+    # 先删除再插入，重复统计同一天的结果一致
+    DailyStats.query.filter(DailyStats.day >= start.date(), DailyStats.day < end.date()).delete(
+        synchronize_session=False)
+    rows = [dict(values, day=day, category_id=category_id) for (day, category_id), values in stats.items()]
+    if rows:
+        db.session.execute(DailyStats.__table__.insert(), rows)
+
+def rollup_daily_stats(now=None, chunk_days=31):
+    """统计上次之后的每一天（包括今天），已结束的日期不再重复统计，返回处理的天数"""
+    today = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = get_checkpoint(CHECKPOINT_NAME)
+    if start is None:
+        first = min(filter(None, [
+            db.session.query(db.func.min(User.created_at)).scalar(),
+            db.session.query(db.func.min(Post.created_at)).scalar(),
+        ]), default=None)
+        if first is None:
+            return 0
+        start = first.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    end = today + timedelta(days=1)
+    cursor = start
+    while cursor < end:
+        chunk_end = min(cursor + timedelta(days=chunk_days), end)
+        _replace_daily_stats(cursor, chunk_end, compute_daily_stats(cursor, chunk_end))
+        # 今天还没有结束，下次运行时重新统计
+        set_checkpoint(CHECKPOINT_NAME, min(chunk_end, today))
+        db.session.commit()
+        cursor = chunk_end
+    return (end - start).days
+
+def load_daily_stats(start_day, end_day, category_id=SITE):
+    """读取 [start_day, end_day] 每天的统计，没有数据的日期补0；
+    尚未汇总的日期（通常只有今天）按范围实时统计"""
+    start = datetime.combine(start_day, datetime.min.time())
+    end = datetime.combine(end_day, datetime.min.time()) + timedelta(days=1)
+    checkpoint = get_checkpoint(CHECKPOINT_NAME) or start
+
+    stored = {}
+    for row in DailyStats.query.filter(
+        DailyStats.category_id == category_id,
+        DailyStats.day >= start_day,
+        DailyStats.day < min(end, checkpoint).date()
+    ):
+        stored[row.day] = {field: getattr(row, field) or 0 for field in COUNTERS}
+    live_start = max(start, checkpoint)
+    if live_start < end:
+        for (day, row_category), values in compute_daily_stats(live_start, end).items():
+            if row_category == category_id:
+                stored[day] = values
+
+    days = []
+    day = start_day
+    while day <= end_day:
+        days.append(dict(stored.get(day) or dict.fromkeys(COUNTERS, 0), date=day.isoformat()))
+        day += timedelta(days=1)
+    return days
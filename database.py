@@ -0,0 +1,83 @@
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from extensions import db
+
+# 数据库连接配置方案：pragmas为SQLite每个连接建立时执行的PRAGMA，engine_options为连接池参数
+PROFILES = {
+    # SQLite默认设置（回滚日志模式），与之前的行为一致
+    'sqlite-default': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    # WAL模式下读写互不阻塞，写锁冲突时等待而不是立即报 database is locked
+    'sqlite-wal': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,          # 毫秒
+            'mmap_size': 268435456,        # 256MB
+            'cache_size': -65536,          # 负数单位为KB，即64MB
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {},
+    },
+    # PostgreSQL/MySQL：连接池大小与waitress线程数相当，定期回收并在使用前检查连接
+    'server': {
+        'pragmas': {},
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True,
+        },
+    },
+}
+
+def resolve_profile(name, uri):
+    """返回配置方案名称，auto根据数据库类型选择"""
+    is_sqlite = make_url(uri).get_backend_name() == 'sqlite'
+    if name == 'auto':
+        return 'sqlite-wal' if is_sqlite else 'server'
+    if name not in PROFILES:
+        raise RuntimeError(f"未知的数据库配置方案: {name}，可选: auto, {', '.join(PROFILES)}")
+    if PROFILES[name]['pragmas'] and not is_sqlite:
+        raise RuntimeError(f'数据库配置方案 {name} 只适用于SQLite')
+    return name
+
+def _set_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for key, value in pragmas.items():
+                cursor.execute(f'PRAGMA {key}={value}')
+        finally:
+            cursor.close()
+    return on_connect
+
+def init_app(app):
+    """按DATABASE_PROFILE设置连接池参数并初始化db，SQLite在每个连接上执行PRAGMA"""
+    name = resolve_profile(app.config.get('DATABASE_PROFILE', 'auto'), app.config['SQLALCHEMY_DATABASE_URI'])
+    profile = PROFILES[name]
+    # 配置中显式给出的SQLALCHEMY_ENGINE_OPTIONS优先
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**profile['engine_options'], **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+    app.config['DATABASE_PROFILE_NAME'] = name
+    db.init_app(app)
+
+    if profile['pragmas']:
+        with app.app_context():
+            event.listen(db.engine, 'connect', _set_pragmas(profile['pragmas']))
+
+def describe():
+    """返回当前数据库连接的实际设置，用于启动时输出"""
+    engine = db.engine
+    parts = [f"配置方案: {current_app.config.get('DATABASE_PROFILE_NAME')}", f'数据库: {engine.dialect.name}']
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            for key in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size'):
+                parts.append(f'{key}={conn.exec_driver_sql(f"PRAGMA {key}").scalar()}')
+    else:
+        pool = engine.pool
+        parts.append(f'连接池: {pool.status()}')
+    return ', '.join(parts)
@@ -1,13 +1,18 @@
 from app import create_app
 from extensions import db
 from models import User, Category, Post, Comment, Tag, Attachment
+from migrations import upgrade_schema, apply_migrations
+from search_index import search_engine
 import uuid
 
 def init_database():
     app = create_app()
     with app.app_context():
-        # 创建所有表
-        db.create_all()
+        # 创建所有表，并为旧数据库补齐新增的列和索引
+        for column in upgrade_schema():
+            print(f"已添加：{column}")
+        for name in apply_migrations():
+            print(f"已执行迁移：{name}")
         
         # 检查是否已存在初始数据
         if Category.query.first() is None:
@@ -42,6 +47,7 @@ def init_database():
             admin = User(username="admin", email="admin@example.com", is_admin=True)
             admin.set_password("admin123")
             db.session.add(admin)
+            search_engine.index_user(admin)
             db.session.commit()
             print("已创建管理员账户：admin / admin123")
         
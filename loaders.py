@@ -0,0 +1,25 @@
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.attributes import set_committed_value
+from models import User, Category, Post
+
+def without_post_bodies(query):
+    # 列表页只显示存储的预览，不读取正文和渲染后的HTML
+    return query.options(defer(Post.content), defer(Post.content_html))
+
+def load_post_aggregates(posts):
+    """为列表页的一页帖子批量加载作者、版块和计数，查询数量与每页帖子数无关"""
+    posts = list(posts)
+    if not posts:
+        return posts
+
+    # 作者和版块各用一次IN查询加载，并直接挂到帖子对象上，模板访问时不再懒加载
+    user_ids = {post.user_id for post in posts}
+    category_ids = {post.category_id for post in posts}
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    categories = {category.id: category for category in Category.query.filter(Category.id.in_(category_ids))}
+    for post in posts:
+        set_committed_value(post, 'author', users.get(post.user_id))
+        set_committed_value(post, 'category', categories.get(post.category_id))
+
+    # 评论数和赞/踩数是帖子表的计数列，随帖子一起读取；升级前的数据由迁移 0001_recount_counters 重新计算
+    return posts
@@ -0,0 +1,180 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from extensions import db
+from models import RequestLog, RequestLogRollup, JobCheckpoint
+
+CHECKPOINT_NAME = 'request_log_rollup'
+# 请求日志由后台队列异步写入，刚结束的小时可能还有日志未写入，等待该时长后再汇总
+ROLLUP_GRACE = timedelta(minutes=5)
+
+def _hour_start(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def _day_start(value):
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+PERCENTILES = (50, 95, 99)
+
+def _bucket_expression(period):
+    # 小时汇总按小时分组，天汇总每次只处理一天，整段时间为一组
+    if period == 'hour':
+        return db.func.strftime('%Y-%m-%d %H:00:00', RequestLog.timestamp)
+    return db.literal('')
+
+def _aggregate(period, start, end):
+    """在数据库中按时间段和端点汇总原始日志，只读回汇总结果和百分位数所在的行，返回 (汇总行列表, 日志条数)"""
+    bucket = _bucket_expression(period).label('bucket')
+    endpoint = db.func.coalesce(RequestLog.endpoint, '').label('endpoint')
+    in_range = (RequestLog.timestamp >= start, RequestLog.timestamp < end)
+
+    def status_count(group):
+        return db.func.sum(db.case((RequestLog.status_code // 100 == group, 1), else_=0))
+
+    totals = db.session.query(
+        bucket, endpoint, db.func.count(), status_count(2), status_count(3), status_count(4), status_count(5),
+        db.func.avg(RequestLog.response_time)
+    ).filter(*in_range).group_by(bucket, endpoint).all()
+
+    # 最近秩法计算百分位数：按响应时间排序后取第 ceil(n * p / 100) 行
+    partition = (_bucket_expression(period), db.func.coalesce(RequestLog.endpoint, ''))
+    ranked = db.session.query(
+        bucket, endpoint, RequestLog.response_time.label('response_time'),
+        db.func.row_number().over(partition_by=partition, order_by=RequestLog.response_time).label('position'),
+        db.func.count().over(partition_by=partition).label('total'),
+    ).filter(*in_range, RequestLog.response_time.isnot(None)).subquery()
+    wanted = [(ranked.c.total * percent + 99) // 100 for percent in PERCENTILES]
+    percentiles = defaultdict(dict)
+    for row in db.session.query(ranked).filter(ranked.c.position.in_(wanted)):
+        for percent in PERCENTILES:
+            if row.position == (row.total * percent + 99) // 100:
+                percentiles[(row.bucket, row.endpoint)][percent] = row.response_time
+
+    rows = []
+    processed = 0
+    for key, endpoint_name, count, status_2xx, status_3xx, status_4xx, status_5xx, avg_time in totals:
+        bucket_start = datetime.strptime(key, '%Y-%m-%d %H:%M:%S') if period == 'hour' else start
+        values = percentiles.get((key, endpoint_name), {})
+        processed += count
+        rows.append({
+            'period': period,
+            'bucket_start': bucket_start,
+            'endpoint': endpoint_name,
+            'request_count': count,
+            'status_2xx': status_2xx,
+            'status_3xx': status_3xx,
+            'status_4xx': status_4xx,
+            'status_5xx': status_5xx,
+            'avg_response_time': avg_time,
+            'p50_response_time': values.get(50),
+            'p95_response_time': values.get(95),
+            'p99_response_time': values.get(99),
+        })
+    return rows, processed
+
+def _replace_rollups(period, start, end, rows):
+    # 先删除再插入，重复运行同一时间段的结果一致
+    RequestLogRollup.query.filter(
+        RequestLogRollup.period == period,
+        RequestLogRollup.bucket_start >= start,
+        RequestLogRollup.bucket_start < end
+    ).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(RequestLogRollup.__table__.insert(), rows)
+
+def get_checkpoint(name):
+    checkpoint = db.session.get(JobCheckpoint, name)
+    return checkpoint.position if checkpoint else None
+
+def set_checkpoint(name, position):
+    checkpoint = db.session.get(JobCheckpoint, name)
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name=name)
+        db.session.add(checkpoint)
+    checkpoint.position = position
+
+def rollup_request_logs(now=None):
+    """把上次汇总之后已结束的小时汇总为小时/天统计，返回处理的原始日志条数"""
+    end = _hour_start((now or datetime.utcnow()) - ROLLUP_GRACE)
+    start = get_checkpoint(CHECKPOINT_NAME)
+    if start is None:
+        first = db.session.query(db.func.min(RequestLog.timestamp)).scalar()
+        if first is None:
+            return 0
+        start = _hour_start(first)
+
+    processed = 0
+    cursor = start
+    # 按天分段处理，每段在一个事务中完成
+    while cursor < end:
+        day_start = _day_start(cursor)
+        day_end = day_start + timedelta(days=1)
+        chunk_end = min(day_end, end)
+
+        rows, count = _aggregate('hour', cursor, chunk_end)
+        _replace_rollups('hour', cursor, chunk_end, rows)
+        processed += count
+        # 一天结束后再生成当天的汇总，百分位数需要基于全天的原始数据计算
+        if chunk_end == day_end:
+            _replace_rollups('day', day_start, day_end, _aggregate('day', day_start, day_end)[0])
+
+        set_checkpoint(CHECKPOINT_NAME, chunk_end)
+        db.session.commit()
+        cursor = chunk_end
+
+    return processed
+
+def prune_request_logs(days, batch_size=5000, now=None):
+    """删除超过保留天数的原始日志，尚未生成天汇总的日志不会被删除"""
+    if days < 1:
+        raise ValueError('请求日志至少保留1天')
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    checkpoint = get_checkpoint(CHECKPOINT_NAME)
+    if checkpoint is None:
+        return 0
+    # 小时汇总可能已处理到当天，但当天的天汇总要到一天结束后才生成，只删除已生成天汇总的日期
+    cutoff = min(cutoff, _day_start(checkpoint))
+
+    deleted = 0
+    while True:
+        # 分批删除，避免长时间占用写锁
+        ids = db.session.query(RequestLog.id).filter(RequestLog.timestamp < cutoff).limit(batch_size).subquery()
+        count = RequestLog.query.filter(RequestLog.id.in_(db.select(ids.c.id))).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            break
+    return deleted
+
+def load_endpoint_summary(start, end=None):
+    """从汇总表读取时间段内各端点的请求统计，短时间段使用小时汇总"""
+    end = end or datetime.utcnow()
+    period = 'hour' if end - start <= timedelta(days=2) else 'day'
+    bucket_start = _hour_start(start) if period == 'hour' else _day_start(start)
+
+    rows = db.session.query(
+        RequestLogRollup.endpoint,
+        db.func.sum(RequestLogRollup.request_count).label('request_count'),
+        db.func.sum(RequestLogRollup.status_4xx).label('status_4xx'),
+        db.func.sum(RequestLogRollup.status_5xx).label('status_5xx'),
+        (db.func.sum(RequestLogRollup.avg_response_time * RequestLogRollup.request_count)
+         / db.func.sum(RequestLogRollup.request_count)).label('avg_response_time'),
+        db.func.max(RequestLogRollup.p95_response_time).label('max_p95_response_time'),
+        db.func.max(RequestLogRollup.p99_response_time).label('max_p99_response_time'),
+    ).filter(
+        RequestLogRollup.period == period,
+        RequestLogRollup.bucket_start >= bucket_start,
+        RequestLogRollup.bucket_start < end
+    ).group_by(RequestLogRollup.endpoint).order_by(db.desc('request_count')).all()
+    return period, rows
+
+def load_daily_request_counts(start, end=None):
+    end = end or datetime.utcnow()
+    rows = db.session.query(
+        RequestLogRollup.bucket_start,
+        db.func.sum(RequestLogRollup.request_count)
+    ).filter(
+        RequestLogRollup.period == 'day',
+        RequestLogRollup.bucket_start >= _day_start(start),
+        RequestLogRollup.bucket_start < end
+    ).group_by(RequestLogRollup.bucket_start).order_by(RequestLogRollup.bucket_start).all()
+    return [{'date': bucket.strftime('%Y-%m-%d'), 'count': count} for bucket, count in rows]
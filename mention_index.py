@@ -0,0 +1,85 @@
+import re
+from extensions import db
+from models import User, Post, Comment, Mention
+
+# @用户名，前面不能紧跟字母数字，避免匹配邮箱地址
+MENTION_RE = re.compile(r'(?<![\w@])@([\w-]+(?:\.[\w-]+)*)')
+
+def extract_usernames(text):
+    return set(MENTION_RE.findall(text or ''))
+
+def _resolve(text, author_id):
+    names = extract_usernames(text)
+    if not names:
+        return set()
+    rows = db.session.query(User.id).filter(User.username.in_(names), User.id != author_id)
+    return {row.id for row in rows}
+
+def _sync(user_ids, author_id, post_id, comment_id):
+    # 只增删有变化的提醒，编辑后仍然存在的提醒保留已读状态
+    existing = Mention.query.filter_by(post_id=post_id, comment_id=comment_id).all()
+    current = {mention.user_id: mention for mention in existing}
+    for user_id, mention in current.items():
+        if user_id not in user_ids:
+            db.session.delete(mention)
+    for user_id in user_ids - current.keys():
+        db.session.add(Mention(user_id=user_id, author_id=author_id, post_id=post_id, comment_id=comment_id))
+
+def update_post_mentions(post):
+    """发布或编辑帖子后更新正文中的@提醒，需在帖子写入（flush）之后调用"""
+    _sync(_resolve(post.content, post.user_id), post.user_id, post.id, None)
+
+def update_comment_mentions(comment):
+    """发布或编辑评论后更新@提醒，需在评论写入（flush）之后调用"""
+    _sync(_resolve(comment.content, comment.user_id), comment.user_id, comment.post_id, comment.id)
+
+def remove_post(post_id):
+    # 删除帖子时删除帖子和其评论中的提醒
+    Mention.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+def remove_user(user_id):
+    # 需在删除用户的帖子之前调用
+    user_posts = db.select(Post.id).where(Post.user_id == user_id)
+    Mention.query.filter(db.or_(
+        Mention.user_id == user_id,
+        Mention.author_id == user_id,
+        Mention.post_id.in_(user_posts)
+    )).delete(synchronize_session=False)
+
+def unread_count(user_id):
+    return Mention.query.filter_by(user_id=user_id, is_read=False).count()
+
+def mark_read(user_id, mention_ids=None):
+    """把提醒标记为已读，mention_ids为None时标记全部"""
+    query = Mention.query.filter_by(user_id=user_id, is_read=False)
+    if mention_ids is not None:
+        query = query.filter(Mention.id.in_(mention_ids))
+    return query.update({Mention.is_read: True}, synchronize_session=False)
+
+def rebuild(batch_size=500):
+    """根据所有帖子和评论重建提醒表，旧数据视为已读，返回提醒数"""
+    usernames = {}
+    for row in db.session.query(User.id, User.username):
+        usernames[row.username] = row.id
+
+    def resolve(text, author_id):
+        user_ids = {usernames.get(name) for name in extract_usernames(text)}
+        return user_ids - {None, author_id}
+
+    rows = []
+    sources = [
+        db.session.query(Post.id.label('post_id'), db.null().label('comment_id'), Post.user_id, Post.content, Post.created_at),
+        db.session.query(Comment.post_id, Comment.id.label('comment_id'), Comment.user_id, Comment.content, Comment.created_at),
+    ]
+    for source in sources:
+        for row in source.yield_per(batch_size):
+            for user_id in resolve(row.content, row.user_id):
+                rows.append({
+                    'user_id': user_id, 'author_id': row.user_id, 'post_id': row.post_id,
+                    'comment_id': row.comment_id, 'created_at': row.created_at, 'is_read': True,
+                })
+
+    Mention.query.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(db.insert(Mention), rows)
+    return len(rows)
@@ -0,0 +1,112 @@
+from sqlalchemy import inspect, text
+from extensions import db
+from models import Post, Comment, SchemaMigration
+
+def upgrade_schema():
+    """为已存在的数据库补齐新增的表、列和索引"""
+    # 创建缺失的表
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    added = []
+    created_index = False
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                # 新增列统一允许为空，服务端默认值一并带上
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f'ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    if isinstance(default, str):
+                        default = "'" + default.replace("'", "''") + "'"
+                    else:
+                        default = default.text
+                    ddl += f' DEFAULT {default}'
+                conn.execute(text(ddl))
+                added.append(f'{table.name}.{column.name}')
+
+            # 为已存在的表补齐新增的索引
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=conn)
+                    added.append(f'{table.name}.{index.name}')
+                    created_index = True
+
+        # 新建索引后更新统计信息，让SQLite查询优化器选择新索引
+        if created_index and db.engine.dialect.name == 'sqlite':
+            conn.execute(text('ANALYZE'))
+
+    return added
+
+# 按顺序执行的数据迁移，执行记录保存在schema_migration表中，每个迁移只执行一次
+MIGRATIONS = []
+
+def migration(name):
+    def decorator(func):
+        MIGRATIONS.append((name, func))
+        return func
+    return decorator
+
+@migration('0001_recount_counters')
+def _recount_counters():
+    # 新增的计数列默认值为0，按评论表和投票表补齐旧数据
+    import counters
+    counters.recount_posts()
+    counters.recount_comments()
+
+@migration('0002_render_content')
+def _render_content():
+    # 为旧帖子和评论生成存储的HTML和预览
+    from commands import rerender_model
+    for model in (Post, Comment):
+        rerender_model(model)
+
+@migration('0003_build_search_index')
+def _build_search_index():
+    from search_index import search_engine
+    search_engine.rebuild()
+
+@migration('0004_build_conversations')
+def _build_conversations():
+    # 根据已有私信生成对话摘要
+    import conversations
+    conversations.rebuild()
+
+@migration('0005_build_mentions')
+def _build_mentions():
+    # 解析已有帖子和评论中的@提醒
+    import mention_index
+    mention_index.rebuild()
+
+@migration('0006_content_addressed_attachments')
+def _import_attachments():
+    # 把按文件名平铺保存的旧附件移入按内容哈希分目录保存的存储
+    from attachments import attachment_storage
+    attachment_storage.import_legacy()
+
+@migration('0007_unread_message_index')
+def _drop_message_recipient_read_index():
+    # 已由只包含未读消息的部分索引 ix_message_unread 代替
+    db.session.execute(text('DROP INDEX IF EXISTS ix_message_recipient_read'))
+
+def apply_migrations():
+    """执行尚未执行的数据迁移，返回本次执行的迁移名称"""
+    applied = {row.name for row in SchemaMigration.query}
+    executed = []
+    for name, func in MIGRATIONS:
+        if name in applied:
+            continue
+        func()
+        db.session.add(SchemaMigration(name=name))
+        # 每个迁移单独提交，中途失败时已完成的迁移不会重复执行
+        db.session.commit()
+        executed.append(name)
+    return executed
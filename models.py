@@ -2,7 +2,7 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from extensions import db
-import markdown
+from rendering import content_hash, render_markdown, render_cached, html_to_text, PREVIEW_LENGTH
 import uuid
 
 # 用户好友关系表
@@ -26,7 +26,8 @@ user_blacklist = db.Table('user_blacklist',
 # 帖子标签关联表
 post_tags = db.Table('post_tags',
     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_post_tags_tag', 'tag_id', 'post_id')
 )
 
 # 帖子收藏关联表
@@ -49,6 +50,38 @@ comment_votes = db.Table('comment_votes',
     db.Column('vote_type', db.Integer)  # 1: 赞, -1: 踩
 )
 
+class RenderedContentMixin:
+    # 渲染后的HTML与源内容一起存储，content_hash用于判断存储的HTML是否过期
+    content_html = db.Column(db.Text)
+    content_hash = db.Column(db.String(40))
+    # 纯文本预览，多保存一个字符用于判断是否需要省略号
+    content_preview = db.Column(db.String(PREVIEW_LENGTH + 1))
+
+    def render_content(self):
+        # 在写入时渲染Markdown并生成预览，阅读时直接使用存储的结果
+        self.content_hash = content_hash(self.content)
+        self.content_html = render_markdown(self.content)
+        self.content_preview = html_to_text(self.content_html)[:PREVIEW_LENGTH + 1]
+
+    def get_content_html(self):
+        digest = content_hash(self.content)
+        if self.content_html is not None and self.content_hash == digest:
+            return self.content_html
+        # 旧数据或渲染器版本变化时回退到进程内缓存
+        return render_cached(self.content, digest)
+
+    def get_content_preview(self, length=100):
+        # 获取内容预览，去除HTML标签并截取指定长度
+        if self.content_preview is not None and length <= PREVIEW_LENGTH:
+            clean_content = self.content_preview
+        else:
+            # 没有存储的预览或需要更长的预览时才渲染完整内容
+            clean_content = html_to_text(self.get_content_html())
+        # 截取指定长度
+        if len(clean_content) > length:
+            return clean_content[:length] + '...'
+        return clean_content
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: f"iwz-f-u-{uuid.uuid4()}")
@@ -61,6 +94,11 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_user_created', 'created_at', 'id'),
+        db.Index('ix_user_last_seen', 'last_seen'),
+    )
+    
     # 关系
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
@@ -205,6 +243,9 @@ class Category(db.Model):
     name = db.Column(db.String(100), unique=True, nullable=False)
     description = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 版块内的帖子、评论或投票变化时递增，用于生成页面的ETag
+    version = db.Column(db.Integer, default=0, server_default='0')
+    changed_at = db.Column(db.DateTime)
     
     # 关系
     posts = db.relationship('Post', backref='category', lazy='dynamic')
@@ -223,7 +264,7 @@ class Tag(db.Model):
     def __repr__(self):
         return f'<Tag {self.name}>'
 
-class Post(db.Model):
+class Post(RenderedContentMixin, db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: f"iwz-f-{uuid.uuid4()}")
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -235,82 +276,55 @@ class Post(db.Model):
     is_reported = db.Column(db.Boolean, default=False) # 被举报
     file_path = db.Column(db.String(300))              # 上传的文件路径
     file_name = db.Column(db.String(200))              # 上传的文件名
+    comment_count = db.Column(db.Integer, default=0, server_default='0')   # 评论数
+    upvote_count = db.Column(db.Integer, default=0, server_default='0')    # 赞数
+    downvote_count = db.Column(db.Integer, default=0, server_default='0')  # 踩数
     
     # 外键
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     
+    # 列表页按 (created_at, id) 倒序分页，索引包含筛选列和排序列
+    __table_args__ = (
+        db.Index('ix_post_created', 'created_at', 'id'),
+        db.Index('ix_post_category_created', 'category_id', 'created_at', 'id'),
+        db.Index('ix_post_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_post_essence_created', 'is_essence', 'created_at', 'id'),
+    )
+    
     # 关系
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     attachments = db.relationship('Attachment', backref='post', lazy='dynamic')
     
     def get_vote_count(self):
-        # 计算赞/踩数量
-        votes = db.session.query(post_votes).filter_by(post_id=self.id).all()
-        upvotes = sum(1 for vote in votes if vote.vote_type == 1)
-        downvotes = sum(1 for vote in votes if vote.vote_type == -1)
-        return upvotes, downvotes
-        
-    def get_content_html(self):
-        # 将Markdown内容转换为HTML
-        md = markdown.Markdown(extensions=['fenced_code', 'tables'])
-        html = md.convert(self.content)
-        # 确保代码块被正确包装以便复制功能工作
-        return html
-        
-    def get_content_preview(self, length=100):
-        # 获取内容预览，去除HTML标签并截取指定长度
-        import re
-        # 先转换Markdown为HTML，然后去除HTML标签
-        html_content = self.get_content_html()
-        # 去除HTML标签
-        clean_content = re.sub('<[^<]+?>', '', html_content)
-        # 去除多余空白字符
-        clean_content = re.sub(r'\s+', ' ', clean_content).strip()
-        # 截取指定长度
-        if len(clean_content) > length:
-            return clean_content[:length] + '...'
-        return clean_content
+        # 赞/踩数量由投票时维护的计数列提供
+        return self.upvote_count or 0, self.downvote_count or 0
         
     def __repr__(self):
         return f'<Post {self.title}>'
 
-class Comment(db.Model):
+class Comment(RenderedContentMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_reported = db.Column(db.Boolean, default=False) # 被举报
+    upvote_count = db.Column(db.Integer, default=0, server_default='0')    # 赞数
+    downvote_count = db.Column(db.Integer, default=0, server_default='0')  # 踩数
     
     # 外键
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.String(36), db.ForeignKey('post.id'), nullable=False)
     
+    __table_args__ = (
+        db.Index('ix_comment_post_created', 'post_id', 'created_at'),
+        db.Index('ix_comment_user_created', 'user_id', 'created_at'),
+        db.Index('ix_comment_created', 'created_at'),
+    )
+    
     def get_vote_count(self):
-        # 计算赞/踩数量
-        votes = db.session.query(comment_votes).filter_by(comment_id=self.id).all()
-        upvotes = sum(1 for vote in votes if vote.vote_type == 1)
-        downvotes = sum(1 for vote in votes if vote.vote_type == -1)
-        return upvotes, downvotes
+        # 赞/踩数量由投票时维护的计数列提供
+        return self.upvote_count or 0, self.downvote_count or 0
         
-    def get_content_html(self):
-        # 将Markdown内容转换为HTML
-        md = markdown.Markdown(extensions=['fenced_code', 'tables'])
-        return md.convert(self.content)
-    
-    def get_content_preview(self, length=100):
-        # 获取内容预览，去除HTML标签并截取指定长度
-        import re
-        # 先转换Markdown为HTML，然后去除HTML标签
-        html_content = self.get_content_html()
-        # 去除HTML标签
-        clean_content = re.sub('<[^<]+?>', '', html_content)
-        # 去除多余空白字符
-        clean_content = re.sub(r'\s+', ' ', clean_content).strip()
-        # 截取指定长度
-        if len(clean_content) > length:
-            return clean_content[:length] + '...'
-        return clean_content
-    
     def __repr__(self):
         return f'<Comment {self.id}>'
 
@@ -322,6 +336,14 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False)
     
+    __table_args__ = (
+        db.Index('ix_message_sender_recipient_created', 'sender_id', 'recipient_id', 'created_at'),
+        db.Index('ix_message_recipient_created', 'recipient_id', 'created_at'),
+        # 只包含未读消息的部分索引，已读消息再多也不影响标记已读的查询计划
+        db.Index('ix_message_unread', 'recipient_id', 'sender_id', sqlite_where=db.text('is_read = 0')),
+        db.Index('ix_message_created', 'created_at'),
+    )
+    
     # 关系
     sender = db.relationship('User', foreign_keys=[sender_id])
     recipient = db.relationship('User', foreign_keys=[recipient_id])
@@ -329,6 +351,51 @@ class Message(db.Model):
     def __repr__(self):
         return f'<Message {self.id}>'
 
+class Conversation(db.Model):
+    # 每个用户的每个对话一行，保存最后一条消息和未读数，私信列表只读取此表
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    partner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer)
+    last_sender_id = db.Column(db.Integer)
+    last_message_preview = db.Column(db.String(100))
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_conversation_user_partner', 'user_id', 'partner_id', unique=True),
+        db.Index('ix_conversation_user_last_message', 'user_id', 'last_message_at', 'id'),
+    )
+    
+    # 关系
+    partner = db.relationship('User', foreign_keys=[partner_id])
+    
+    def __repr__(self):
+        return f'<Conversation {self.user_id} {self.partner_id}>'
+
+class Mention(db.Model):
+    # 帖子或评论中的@提醒，发布和编辑时解析写入；comment_id为空表示在帖子正文中
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_id = db.Column(db.String(36), db.ForeignKey('post.id'), nullable=False, index=True)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    is_read = db.Column(db.Boolean, default=False)
+    
+    __table_args__ = (
+        db.Index('ix_mention_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_mention_user_read', 'user_id', 'is_read'),
+    )
+    
+    # 关系
+    author = db.relationship('User', foreign_keys=[author_id])
+    post = db.relationship('Post')
+    comment = db.relationship('Comment')
+    
+    def __repr__(self):
+        return f'<Mention {self.user_id} {self.post_id} {self.comment_id}>'
+
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     reporter_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -338,6 +405,10 @@ class Report(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='pending')  # pending, resolved, dismissed
     
+    __table_args__ = (
+        db.Index('ix_report_status_created', 'status', 'created_at'),
+    )
+    
     # 关系
     reporter = db.relationship('User', foreign_keys=[reporter_id])
     
@@ -352,6 +423,12 @@ class Vote(db.Model):
     vote_type = db.Column(db.Integer, nullable=False)  # 1: 赞, -1: 踩
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_vote_user_target', 'user_id', 'voted_type', 'voted_id'),
+        db.Index('ix_vote_target', 'voted_type', 'voted_id', 'vote_type'),
+        db.Index('ix_vote_created', 'created_at'),
+    )
+    
     # 关系
     user = db.relationship('User')
     
@@ -361,21 +438,36 @@ class Vote(db.Model):
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(200), nullable=False)    # 文件名
-    file_path = db.Column(db.String(300), nullable=False)   # 文件路径
+    file_path = db.Column(db.String(300), nullable=False)   # 文件路径（相对于UPLOAD_FOLDER）
     file_size = db.Column(db.Integer)                       # 文件大小(字节)
     file_type = db.Column(db.String(50))                    # 文件类型
+    content_hash = db.Column(db.String(64), index=True)     # 文件内容的SHA-256，对应AttachmentBlob
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # 外键
-    post_id = db.Column(db.String(36), db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.String(36), db.ForeignKey('post.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
     # 关系
     user = db.relationship('User')
     
+    def is_image(self):
+        # 按上传时检查的文件头判断，旧版本的附件没有内容哈希，不生成缩略图
+        return bool(self.content_hash) and (self.file_type or '').startswith('image/')
+    
     def __repr__(self):
         return f'<Attachment {self.filename}>'
 
+class AttachmentBlob(db.Model):
+    # 按内容保存的附件文件，内容相同的附件共用一个文件，ref_count为引用它的附件数
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AttachmentBlob {self.hash}>'
+
 class RequestLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ip_address = db.Column(db.String(45), nullable=False)      # 支持IPv6
@@ -384,13 +476,86 @@ class RequestLog(db.Model):
     url = db.Column(db.Text, nullable=False)                   # 请求URL
     status_code = db.Column(db.Integer, nullable=False)        # 响应状态码
     response_time = db.Column(db.Float)                        # 响应时间(毫秒)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow) # 请求时间
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True) # 请求时间
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 用户ID(如果已登录)
     referrer = db.Column(db.Text)                              # 引荐页面
     content_length = db.Column(db.Integer)                     # 请求内容长度
+    endpoint = db.Column(db.String(100))                       # 路由端点
     
     # 关系
     user = db.relationship('User', backref='request_logs')
     
     def __repr__(self):
         return f'<RequestLog {self.ip_address} {self.method} {self.url}>'
+
+class RequestLogRollup(db.Model):
+    # 请求日志按小时/按天汇总，原始日志清理后仍可查看历史统计
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(10), nullable=False)          # 'hour' 或 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)      # 时间段开始
+    endpoint = db.Column(db.String(100), nullable=False)       # 路由端点
+    request_count = db.Column(db.Integer, default=0)           # 请求数
+    status_2xx = db.Column(db.Integer, default=0)
+    status_3xx = db.Column(db.Integer, default=0)
+    status_4xx = db.Column(db.Integer, default=0)
+    status_5xx = db.Column(db.Integer, default=0)
+    avg_response_time = db.Column(db.Float)                    # 平均响应时间(毫秒)
+    p50_response_time = db.Column(db.Float)
+    p95_response_time = db.Column(db.Float)
+    p99_response_time = db.Column(db.Float)
+    
+    __table_args__ = (
+        db.Index('ix_request_log_rollup_bucket', 'period', 'bucket_start', 'endpoint', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<RequestLogRollup {self.period} {self.bucket_start} {self.endpoint}>'
+
+class DailyStats(db.Model):
+    # 每天的站点统计，category_id为0表示全站，其余为各版块（版块行只统计帖子、评论和活跃用户）
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    category_id = db.Column(db.Integer, nullable=False, default=0)
+    new_users = db.Column(db.Integer, default=0)
+    posts = db.Column(db.Integer, default=0)
+    comments = db.Column(db.Integer, default=0)
+    votes = db.Column(db.Integer, default=0)
+    messages = db.Column(db.Integer, default=0)
+    active_users = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_daily_stats_category_day', 'category_id', 'day', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<DailyStats {self.day} {self.category_id}>'
+
+class JobCheckpoint(db.Model):
+    # 记录后台任务处理到的位置，任务只处理上次之后的新数据
+    name = db.Column(db.String(50), primary_key=True)
+    position = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<JobCheckpoint {self.name} {self.position}>'
+
+class SearchDocument(db.Model):
+    # 全文索引的文档编号，FTS5表的rowid与此表的id对应
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)    # post/user
+    doc_id = db.Column(db.String(36), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_search_document_kind_doc', 'kind', 'doc_id', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<SearchDocument {self.kind} {self.doc_id}>'
+
+class SchemaMigration(db.Model):
+    # 已执行的数据迁移，每个迁移只执行一次
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.name}>'
@@ -0,0 +1,88 @@
+import hashlib
+import time
+from datetime import datetime
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from extensions import db
+from models import Category
+from avatars import avatar_processor
+
+# 进程启动时间，部署新模板后旧的ETag全部失效
+_STARTED_AT = repr(time.time())
+
+def bump_categories(category_ids=None):
+    """版块内的帖子、评论、投票变化后在同一事务中调用，使相关页面的ETag失效；None表示所有版块"""
+    table = Category.__table__
+    statement = table.update().values(version=table.c.version + 1, changed_at=datetime.utcnow())
+    if category_ids is not None:
+        category_ids = {int(category_id) for category_id in category_ids if category_id is not None}
+        if not category_ids:
+            return
+        statement = statement.where(table.c.id.in_(category_ids))
+    db.session.execute(statement)
+
+def category_version(category_id):
+    """返回 (版本号, 最后变化时间)"""
+    row = db.session.query(Category.version, Category.changed_at).filter_by(id=category_id).first()
+    return (row.version, row.changed_at) if row else (0, None)
+
+def site_version():
+    """所有版块合并的版本，返回 (版本标识, 最后变化时间)"""
+    row = db.session.query(
+        db.func.coalesce(db.func.sum(Category.version), 0), db.func.count(Category.id), db.func.max(Category.changed_at)
+    ).one()
+    return (row[0], row[1]), row[2]
+
+def stats_period():
+    """全站统计的缓存周期，返回 (周期编号, 周期开始时间)；首页等页面的统计数字最多每个周期变化一次"""
+    ttl = max(1, current_app.config.get('SITE_STATS_TTL', 60))
+    period = int(time.time() // ttl)
+    return period, datetime.utcfromtimestamp(period * ttl)
+
+def latest(*times):
+    times = [value for value in times if value is not None]
+    return max(times) if times else None
+
+def _viewer():
+    # 导航栏和页面中的表单与当前用户及会话的CSRF令牌有关；
+    # 先生成令牌，新会话第一次访问得到的ETag与之后的请求一致
+    generate_csrf()
+    user = None
+    if current_user.is_authenticated:
+        user = (current_user.id, current_user.username, current_user.is_admin, avatar_processor.url(current_user, 64))
+    return user, session.get('csrf_token')
+
+def page_etag(*parts):
+    """根据页面内容的版本和当前用户计算ETag，parts应当足以判断页面是否变化"""
+    key = repr((_STARTED_AT, _viewer(), request.full_path) + parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def not_modified(etag, last_modified=None):
+    """客户端缓存的页面仍然有效时返回304响应，否则返回None，由路由继续生成页面"""
+    # 有待显示的提示消息时页面内容不同，这次不使用也不产生缓存
+    if session.get('_flashes'):
+        g.skip_page_validators = True
+        return None
+    response = current_app.response_class()
+    _set_validators(response, etag, last_modified)
+    response.make_conditional(request)
+    return response if response.status_code == 304 else None
+
+def with_validators(body, etag, last_modified=None):
+    """为生成的页面加上ETag、Last-Modified和Cache-Control"""
+    response = make_response(body)
+    if g.get('skip_page_validators'):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    _set_validators(response, etag, last_modified)
+    return response
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # 每个页面都包含会话的CSRF令牌，不能由代理等共享缓存保存；浏览器可以缓存，但每次使用前需要验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
@@ -0,0 +1,129 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from extensions import db
+
+class KeysetPage:
+    """基于游标的一页结果，可以像列表一样遍历；游标为None表示没有上一页/下一页"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+# SQLite整数的范围，超出时绑定参数会报错
+_INT_MIN, _INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _valid_value(column, value):
+    # 游标来自URL，值的类型必须与排序列一致，否则查询时会出错
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return isinstance(value, (str, int, float)) and not isinstance(value, bool)
+    if python_type is datetime:
+        return isinstance(value, datetime)
+    if python_type is int:
+        return isinstance(value, int) and not isinstance(value, bool) and _INT_MIN <= value <= _INT_MAX
+    return isinstance(value, python_type)
+
+def encode_cursor(values, direction):
+    data = json.dumps({'v': [_encode_value(value) for value in values], 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, columns):
+    """解析游标，返回 (排序列的值, 方向)；无效的游标返回 (None, 'next')，即显示第一页"""
+    if not cursor:
+        return None, 'next'
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = [_decode_value(value) for value in data['v']] if isinstance(data['v'], list) else None
+        direction = data['d']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None, 'next'
+    if not isinstance(values, list) or len(values) != len(columns) or direction not in ('next', 'prev'):
+        return None, 'next'
+    if not all(_valid_value(column, value) for column, value in zip(columns, values)):
+        return None, 'next'
+    return values, direction
+
+def _after(columns, values, descending):
+    # 展开为 (a < x) OR (a = x AND b < y) 的形式，SQLite可以使用 (a, b) 上的索引
+    clauses = []
+    for position, column in enumerate(columns):
+        equal = [columns[i] == values[i] for i in range(position)]
+        compare = column < values[position] if descending else column > values[position]
+        clauses.append(db.and_(*equal, compare))
+    return db.or_(*clauses)
+
+def keyset_query(query, columns, values=None, backward=False):
+    """为查询加上游标条件和排序；values为边界行的排序值，None表示第一页"""
+    if values is not None:
+        query = query.filter(_after(columns, values, descending=not backward))
+    if backward:
+        return query.order_by(*[column.asc() for column in columns])
+    return query.order_by(*[column.desc() for column in columns])
+
+def keyset_paginate_union(model, queries, columns, cursor=None, per_page=20):
+    """对多个查询的并集分页。OR条件无法共用一个索引，每个查询先各自沿索引取一页，
+    合并后再取一页，读取的行数与历史数据量无关"""
+    values, direction = decode_cursor(cursor, columns)
+    backward = values is not None and direction == 'prev'
+    key = columns[-1]
+    branches = [
+        keyset_query(query.with_entities(key), columns, values, backward).limit(per_page + 1).subquery()
+        for query in queries
+    ]
+    ids = db.union_all(*[db.select(*branch.c) for branch in branches])
+    return keyset_paginate(model.query.filter(key.in_(ids)), columns, cursor, per_page)
+
+def keyset_paginate(query, columns, cursor=None, per_page=20):
+    """按 columns 倒序分页（最后一列应唯一，通常为 (created_at, id)），
+    游标中保存上一页边界行的排序值，不使用OFFSET，翻到多深都只读取一页的数据"""
+    values, direction = decode_cursor(cursor, columns)
+    backward = values is not None and direction == 'prev'
+    query = keyset_query(query, columns, values, backward)
+
+    # 多取一条用于判断是否还有更多数据
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backward:
+        items.reverse()
+    if not items:
+        return KeysetPage(items)
+
+    def cursor_for(item, item_direction):
+        return encode_cursor([getattr(item, column.key) for column in columns], item_direction)
+
+    if backward:
+        next_cursor = cursor_for(items[-1], 'next')
+        prev_cursor = cursor_for(items[0], 'prev') if has_more else None
+    else:
+        next_cursor = cursor_for(items[-1], 'next') if has_more else None
+        prev_cursor = cursor_for(items[0], 'prev') if values is not None else None
+    return KeysetPage(items, next_cursor, prev_cursor)
@@ -0,0 +1,170 @@
+import random
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from extensions import db
+from models import User, Category, Tag, Post, Comment, Message, Conversation, Mention, Report, Vote, Attachment, RequestLog, DailyStats, SearchDocument, post_tags, post_favorites, user_friends
+from pagination import keyset_query
+
+# 一条需要检查的查询：名称、查询、必须使用的索引（元组表示其中任一个）、是否允许额外排序
+PlanCheck = namedtuple('PlanCheck', ['name', 'query', 'indexes', 'allow_sort'])
+
+def _check(name, query, indexes=(), allow_sort=False):
+    return PlanCheck(name, query, indexes, allow_sort)
+
+def hot_queries():
+    """各路由的高频查询，形式与路由中的查询一致，参数取示例值"""
+    post_order = (Post.created_at, Post.id)
+    user_order = (User.created_at, User.id)
+    post_cursor = [datetime.utcnow(), 'iwz-f-']
+    user_cursor = [datetime.utcnow(), 0]
+
+    return [
+        _check('首页最新帖子', Post.query.order_by(Post.created_at.desc()).limit(10), ['ix_post_created']),
+        _check('首页活跃用户', User.query.order_by(User.last_seen.desc()).limit(12), ['ix_user_last_seen']),
+        _check('版块帖子列表', keyset_query(Post.query.filter_by(category_id=1), post_order, post_cursor).limit(21),
+               ['ix_post_category_created']),
+        _check('相关帖子', Post.query.filter(Post.category_id == 1, Post.id != 'iwz-f-').order_by(
+            Post.created_at.desc()).limit(5), ['ix_post_category_created']),
+        _check('用户帖子列表', keyset_query(Post.query.filter_by(user_id=1), post_order, post_cursor).limit(11),
+               ['ix_post_user_created']),
+        _check('用户最近回复', Comment.query.filter_by(user_id=1).order_by(
+            Comment.created_at.desc(), Comment.id.desc()).limit(10), ['ix_comment_user_created']),
+        _check('精华帖列表', keyset_query(Post.query.filter_by(is_essence=True), post_order, post_cursor).limit(21),
+               ['ix_post_essence_created']),
+        _check('标签帖子列表', keyset_query(Post.query.join(post_tags).filter(post_tags.c.tag_id == 1),
+                                         post_order, post_cursor).limit(21), [], allow_sort=True),
+        _check('收藏夹', keyset_query(Post.query.join(post_favorites).filter(post_favorites.c.user_id == 1),
+                                   post_order, post_cursor).limit(21), [], allow_sort=True),
+        _check('帖子评论', Comment.query.filter_by(post_id='iwz-f-').order_by(Comment.created_at),
+               ['ix_comment_post_created']),
+        _check('帖子附件', Attachment.query.filter_by(post_id='iwz-f-'), ['ix_attachment_post_id']),
+        _check('附件引用', Attachment.query.filter_by(content_hash='0' * 64), ['ix_attachment_content_hash']),
+        _check('用户投票记录', Vote.query.filter_by(user_id=1, voted_type='post', voted_id=1), ['ix_vote_user_target']),
+        _check('赞/踩计数', db.session.query(db.func.count(Vote.id)).filter(
+            Vote.voted_type == 'post', Vote.voted_id == 1, Vote.vote_type == 1), ['ix_vote_target']),
+        _check('对话消息', keyset_query(Message.query.with_entities(Message.id).filter_by(sender_id=1, recipient_id=2),
+                                    (Message.created_at, Message.id), post_cursor[:1] + [0]).limit(51),
+               ['ix_message_sender_recipient_created']),
+        # 表很小时SQLite可能选择 (sender_id, recipient_id, created_at) 索引，同样不会扫描全表
+        _check('标记私信已读', Message.query.filter(
+            Message.recipient_id == 1, Message.sender_id == 2, Message.is_read == db.false()),
+               [('ix_message_unread', 'ix_message_sender_recipient_created')]),
+        _check('私信列表', keyset_query(Conversation.query.filter_by(user_id=1),
+                                    (Conversation.last_message_at, Conversation.id), post_cursor[:1] + [0]).limit(21),
+               ['ix_conversation_user_last_message']),
+        _check('@提醒列表', keyset_query(Mention.query.filter_by(user_id=1),
+                                     (Mention.created_at, Mention.id), post_cursor[:1] + [0]).limit(21),
+               ['ix_mention_user_created']),
+        _check('未读@提醒数', db.session.query(db.func.count(Mention.id)).filter_by(user_id=1, is_read=False),
+               ['ix_mention_user_read']),
+        _check('待处理举报数', Report.query.filter_by(status='pending'), ['ix_report_status_created']),
+        _check('后台用户列表', User.query.order_by(User.created_at.desc()).limit(20), ['ix_user_created']),
+        _check('请求日志', keyset_query(RequestLog.query.filter(RequestLog.timestamp >= datetime.utcnow() - timedelta(days=7)),
+                                    (RequestLog.timestamp, RequestLog.id)).limit(21), ['ix_request_log_timestamp']),
+        _check('每日回复统计', db.session.query(db.func.date(Comment.created_at), db.func.count(Comment.id)).filter(
+            Comment.created_at >= datetime.utcnow() - timedelta(days=1)).group_by(db.func.date(Comment.created_at)),
+               ['ix_comment_created'], allow_sort=True),
+        _check('每日统计', DailyStats.query.filter(DailyStats.category_id == 0, DailyStats.day >= datetime.utcnow().date()),
+               ['ix_daily_stats_category_day']),
+        _check('好友列表', keyset_query(User.query.join(user_friends, user_friends.c.friend_id == User.id).filter(
+            user_friends.c.user_id == 1), user_order, user_cursor).limit(21), [], allow_sort=True),
+        _check('搜索文档', SearchDocument.query.filter_by(kind='post', doc_id='iwz-f-'),
+               ['ix_search_document_kind_doc']),
+    ]
+
+def build_fixture(connection, seed=0):
+    """在空的SQLite数据库中建表，写入分布接近线上的示例数据并执行ANALYZE：
+    帖子集中在少数版块、大部分私信已读且集中发给少数用户、举报大多已处理等；
+    查询计划依赖表的统计信息，检查结果不受所连接数据库中实际数据的影响"""
+    rng = random.Random(seed)
+    now = datetime(2024, 6, 1)
+    db.metadata.create_all(connection)
+
+    def insert(table, rows):
+        connection.execute(getattr(table, '__table__', table).insert(), rows)
+
+    def skewed(count, hot_share=0.6):
+        # 大部分数据集中在前几个ID
+        return 1 + (rng.randrange(5) if rng.random() < hot_share else rng.randrange(count))
+
+    def ago(max_days):
+        return now - timedelta(seconds=rng.randrange(max_days * 86400))
+
+    users, posts, comments = 300, 3000, 6000
+    insert(User, [dict(user_id=f'u-{i}', username=f'u{i}', email=f'u{i}@example.com', password_hash='x',
+                       created_at=ago(720), last_seen=ago(30)) for i in range(users)])
+    insert(Category, [dict(name=f'c{i}') for i in range(6)])
+    insert(Tag, [dict(name=f't{i}') for i in range(40)])
+    insert(Post, [dict(id=f'iwz-f-{i}', title='t', content='c', created_at=ago(720), user_id=skewed(users),
+                       category_id=skewed(6, 0.8), is_essence=rng.random() < 0.02) for i in range(posts)])
+    insert(Comment, [dict(content='c', created_at=ago(720), user_id=skewed(users),
+                          post_id=f'iwz-f-{skewed(posts) - 1}') for _ in range(comments)])
+    insert(Vote, [dict(user_id=1 + i % users, voted_type='post' if i % 3 else 'comment', voted_id=1 + i // users,
+                       vote_type=1 if rng.random() < 0.8 else -1, created_at=ago(720)) for i in range(6000)])
+    insert(Message, [dict(sender_id=skewed(users), recipient_id=skewed(users, 0.7), content='m', created_at=ago(720),
+                          is_read=rng.random() < 0.97) for _ in range(4000)])
+    insert(Conversation, [dict(user_id=1 + i // 20, partner_id=1 + i % 20 + 20, last_message_at=ago(720), unread_count=0)
+                          for i in range(600)])
+    insert(Mention, [dict(user_id=skewed(users), author_id=skewed(users), post_id=f'iwz-f-{rng.randrange(posts)}',
+                          created_at=ago(720), is_read=rng.random() < 0.95) for _ in range(1500)])
+    insert(Report, [dict(reporter_id=skewed(users), reported_type='post', reported_id=i, reason='r', created_at=ago(720),
+                         status='pending' if rng.random() < 0.05 else 'resolved') for i in range(200)])
+    insert(Attachment, [dict(filename='f', file_path='f', content_hash=f'{i % 400:064x}', post_id=f'iwz-f-{rng.randrange(posts)}',
+                             user_id=skewed(users), created_at=ago(720)) for i in range(500)])
+    insert(RequestLog, [dict(ip_address='127.0.0.1', method='GET', url='/', status_code=200, endpoint='main.index',
+                             timestamp=ago(30)) for _ in range(5000)])
+    insert(DailyStats, [dict(day=(now - timedelta(days=day)).date(), category_id=category)
+                        for day in range(400) for category in range(7)])
+    insert(SearchDocument, [dict(kind='post', doc_id=f'iwz-f-{i}') for i in range(posts)])
+    insert(post_tags, [dict(post_id=i, tag_id=skewed(40)) for i in range(1, 2001)])
+    insert(post_favorites, [dict(user_id=skewed(users), post_id=i) for i in range(1, 1001)])
+    insert(user_friends, [dict(user_id=1 + i // 20, friend_id=1 + i % 20 + 30) for i in range(600)])
+    connection.exec_driver_sql('ANALYZE')
+
+def explain(query, connection=None):
+    """返回查询的 EXPLAIN QUERY PLAN 各行说明"""
+    connection = connection if connection is not None else db.session.connection()
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    # SQLite的查询计划与参数值无关，参数统一传入NULL
+    params = (None,) * len(compiled.positiontup or ())
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params).all()
+    return [row[-1] for row in rows]
+
+_FULL_SCAN_RE = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)\b(?! USING| VIRTUAL TABLE)')
+
+def find_problems(check, plan):
+    problems = []
+    for detail in plan:
+        if _FULL_SCAN_RE.match(detail):
+            problems.append(f'全表扫描: {detail}')
+        if 'USE TEMP B-TREE' in detail and not check.allow_sort:
+            problems.append(f'额外排序: {detail}')
+    for index in check.indexes:
+        candidates = index if isinstance(index, tuple) else (index,)
+        if not any(name in detail for name in candidates for detail in plan):
+            problems.append(f'未使用索引 {"/".join(candidates)}')
+    return problems
+
+def check_query_plans(connection=None):
+    """检查所有高频查询，返回 [(检查项, 查询计划, 问题列表)]；connection为None时检查当前数据库"""
+    dialect = connection.dialect if connection is not None else db.engine.dialect
+    if dialect.name != 'sqlite':
+        raise RuntimeError('查询计划检查只支持SQLite数据库')
+    results = []
+    for check in hot_queries():
+        plan = explain(check.query, connection)
+        results.append((check, plan, find_problems(check, plan)))
+    return results
+
+def check_fixture_query_plans(seed=0):
+    """在内存中的示例数据库上检查所有高频查询，需要在应用上下文中调用"""
+    engine = create_engine('sqlite://')
+    try:
+        with engine.begin() as connection:
+            build_fixture(connection, seed)
+            return check_query_plans(connection)
+    finally:
+        engine.dispose()
@@ -0,0 +1,56 @@
+import hashlib
+import re
+import threading
+import markdown
+from cache import LRUCache
+
+# Markdown扩展列表
+# 修改扩展或渲染逻辑后需要提升RENDERER_VERSION，并运行 flask rerender-content 重新渲染
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables']
+RENDERER_VERSION = 1
+
+# 存储的纯文本预览长度，需不小于模板中请求的最大预览长度
+PREVIEW_LENGTH = 200
+
+# 存储的HTML缺失或过期时使用的进程内缓存，以内容哈希为键
+render_cache = LRUCache(maxsize=512)
+
+# Markdown实例不是线程安全的，每个线程复用自己的实例
+_local = threading.local()
+
+def init_app(app):
+    render_cache.maxsize = app.config.get('MARKDOWN_CACHE_SIZE', 512)
+
+def content_hash(text):
+    # 内容哈希包含渲染器版本，版本变化后所有存储的HTML都会被视为过期
+    data = f'{RENDERER_VERSION}:{text or ""}'.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+def render_markdown(text):
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        _local.md = md
+    md.reset()
+    return md.convert(text or '')
+
+def render_cached(text, digest=None):
+    digest = digest or content_hash(text)
+    html = render_cache.get(digest)
+    if html is None:
+        html = render_markdown(text)
+        render_cache.set(digest, html)
+    return html
+
+def html_to_text(html):
+    # 去除HTML标签和多余空白字符
+    text = re.sub('<[^<]+?>', '', html)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def render_batch(texts):
+    # 供 flask rerender-content 在子进程中批量渲染，返回(哈希, HTML, 预览)
+    results = []
+    for text in texts:
+        html = render_markdown(text)
+        results.append((content_hash(text), html, html_to_text(html)[:PREVIEW_LENGTH + 1]))
+    return results
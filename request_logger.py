@@ -0,0 +1,138 @@
+import atexit
+import queue
+import threading
+import time
+from extensions import db
+from models import RequestLog
+
+# 通知后台线程退出的标记
+_STOP = object()
+
+class RequestLogWriter:
+    """把请求日志放入有界队列，由后台线程在独立连接上批量写入"""
+
+    def __init__(self):
+        self.engine = None
+        self.async_mode = True
+        self.batch_size = 200
+        self.flush_interval = 1.0
+        self.drop_policy = 'drop_new'
+        self.queue_size = 10000
+        self.written = 0
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._stopped = False
+        self._start_lock = threading.Lock()
+        self._atexit_registered = False
+
+    def init_app(self, app):
+        self.async_mode = app.config.get('REQUEST_LOG_ASYNC', True)
+        self.batch_size = app.config.get('REQUEST_LOG_BATCH_SIZE', 200)
+        self.flush_interval = app.config.get('REQUEST_LOG_FLUSH_INTERVAL', 1.0)
+        self.drop_policy = app.config.get('REQUEST_LOG_DROP_POLICY', 'drop_new')
+        self.queue_size = app.config.get('REQUEST_LOG_QUEUE_SIZE', 10000)
+
+        with app.app_context():
+            self.engine = db.engine
+
+    def _ensure_started(self):
+        # 收到第一条日志时才启动后台线程，命令行等不处理请求的进程不会启动
+        with self._start_lock:
+            if self._stopped:
+                return False
+            if self._thread is not None:
+                return True
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                # 进程退出前写入队列中剩余的日志
+                atexit.register(self.stop)
+                self._atexit_registered = True
+            return True
+
+    def submit(self, record):
+        # 停止后（如进程退出时）的日志直接写入
+        if not self.async_mode or not self._ensure_started():
+            self._write([record])
+            return
+
+        if self.drop_policy == 'block':
+            # 队列满时阻塞请求线程，直到后台线程腾出空间
+            self._queue.put(record)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.drop_policy != 'drop_oldest':
+                    # 默认丢弃新日志，不让日志拖慢请求
+                    self.dropped += 1
+                    return
+            # drop_oldest：丢弃最早的一条后重试
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def stop(self, timeout=10):
+        with self._start_lock:
+            self._stopped = True
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            deadline = None
+            # 第一条日志到达后最多再等待flush_interval秒凑满一批
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    running = False
+                    break
+                batch.append(record)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if not running:
+                # 退出前取出队列中剩余的所有日志
+                while True:
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is not _STOP:
+                        batch.append(record)
+
+            for start in range(0, len(batch), self.batch_size):
+                self._write(batch[start:start + self.batch_size])
+
+    def _write(self, records):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(RequestLog.__table__.insert(), records)
+            self.written += len(records)
+        except Exception as e:
+            # 日志写入失败不影响请求本身
+            self.dropped += len(records)
+            print(f"日志记录失败: {str(e)}")
+
+request_log_writer = RequestLogWriter()
@@ -1,9 +1,21 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, abort, send_file
 from flask_login import login_user, logout_user, login_required, current_user
 from extensions import db
 from models import User, Category, Post, Comment, Attachment
-from werkzeug.utils import secure_filename
-from werkzeug.exceptions import RequestEntityTooLarge
+from loaders import load_post_aggregates, without_post_bodies
+from pagination import keyset_paginate
+from view_counter import view_counter
+from stats import get_site_stats
+from avatars import avatar_processor
+from attachments import attachment_storage, streams_attachments
+from thumbnails import thumbnail_generator, THUMBNAIL_SIZES
+from sqlalchemy.orm.attributes import set_committed_value
+from search_index import search_engine
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import counters
+import mention_index
+import page_validators
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 import os
 import markdown
 import bleach
@@ -14,17 +26,27 @@ bp = Blueprint('main', __name__)
 # 首页
 @bp.route('/')
 def index():
-    posts = Post.query.order_by(Post.created_at.desc()).limit(10).all()
+    # 页面内容只随版块版本和统计缓存周期变化，未变化时不查询帖子列表
+    version, changed_at = page_validators.site_version()
+    period, period_start = page_validators.stats_period()
+    etag = page_validators.page_etag('index', version, period)
+    last_modified = page_validators.latest(changed_at, period_start)
+    response = page_validators.not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    posts = load_post_aggregates(Post.query.order_by(Post.created_at.desc()).limit(10))
     categories = Category.query.all()
-    post_count = Post.query.count()
-    comment_count = Comment.query.count()
-    user_count = User.query.count()
-    category_count = Category.query.count()
+    # 全站统计来自缓存，不在每次访问首页时统计全表
+    stats = get_site_stats()
     active_users = User.query.order_by(User.last_seen.desc()).limit(12).all()
-    return render_template('index.html', posts=posts, categories=categories, 
-                          post_count=post_count, comment_count=comment_count, 
-                          user_count=user_count, category_count=category_count,
-                          active_users=active_users)
+    return page_validators.with_validators(
+        render_template('index.html', posts=posts, categories=categories, 
+                        post_count=stats['post_count'], comment_count=stats['comment_count'], 
+                        user_count=stats['user_count'], category_count=stats['category_count'],
+                        category_post_counts=stats['category_post_counts'],
+                        active_users=active_users),
+        etag, last_modified)
 
 # 用户注册
 @bp.route('/register', methods=['GET', 'POST'])
@@ -47,6 +69,7 @@ def register():
         user = User(username=username, email=email)
         user.set_password(password)
         db.session.add(user)
+        search_engine.index_user(user)
         db.session.commit()
         
         flash('注册成功，请登录')
@@ -82,24 +105,55 @@ def logout():
 @bp.route('/categories')
 def categories():
     categories = Category.query.all()
-    return render_template('categories.html', categories=categories)
+    return render_template('categories.html', categories=categories,
+                          category_post_counts=get_site_stats()['category_post_counts'])
 
 # 版块详情
 @bp.route('/category/<int:category_id>')
 def category_detail(category_id):
     category = Category.query.get_or_404(category_id)
-    posts = Post.query.filter_by(category_id=category_id).order_by(Post.created_at.desc()).all()
+    # 侧边栏包含所有版块，使用全站版本
+    version, changed_at = page_validators.site_version()
+    period, period_start = page_validators.stats_period()
+    etag = page_validators.page_etag('category', category.id, category.version, version, period)
+    last_modified = page_validators.latest(changed_at, period_start)
+    response = page_validators.not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    posts = keyset_paginate(
+        without_post_bodies(Post.query.filter_by(category_id=category_id)),
+        (Post.created_at, Post.id), request.args.get('cursor'), per_page=20
+    )
+    load_post_aggregates(posts.items)
     # 获取所有版块（用于侧边栏）
     all_categories = Category.query.all()
-    return render_template('category_detail.html', category=category, posts=posts, all_categories=all_categories)
+    return page_validators.with_validators(
+        render_template('category_detail.html', category=category, posts=posts, all_categories=all_categories,
+                        category_post_counts=get_site_stats()['category_post_counts']),
+        etag, last_modified)
 
 # 帖子详情
 @bp.route('/post/<post_id>')
 def post_detail(post_id):
     post = Post.query.get_or_404(post_id)
-    # 增加浏览量
-    post.view_count += 1
-    db.session.commit()
+    # 增加浏览量：先在内存中累计，由后台线程批量写入，阅读帖子不占用写锁
+    if current_user.is_authenticated:
+        viewer = f'user:{current_user.id}'
+    else:
+        viewer = 'ip:' + request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr or '')
+    view_counter.record(post.id, viewer)
+    # 显示时加上尚未写入数据库的浏览量
+    set_committed_value(post, 'view_count', (post.view_count or 0) + view_counter.pending(post.id))
+
+    # 评论、投票和相关帖子的变化都会增加版块版本；返回304时浏览器显示的浏览量可能不是最新的
+    category_version, category_changed_at = page_validators.category_version(post.category_id)
+    etag = page_validators.page_etag('post', post.id, post.updated_at, post.comment_count,
+                                     post.upvote_count, post.downvote_count, category_version)
+    last_modified = page_validators.latest(post.updated_at, category_changed_at)
+    response = page_validators.not_modified(etag, last_modified)
+    if response is not None:
+        return response
     
     # 获取相关帖子
     related_posts = Post.query.filter(
@@ -107,13 +161,22 @@ def post_detail(post_id):
         Post.id != post.id
     ).order_by(Post.created_at.desc()).limit(5).all()
     
-    return render_template('post_detail.html', post=post, related_posts=related_posts)
+    return page_validators.with_validators(
+        render_template('post_detail.html', post=post, related_posts=related_posts), etag, last_modified)
 
 # 发帖
 @bp.route('/create_post', methods=['GET', 'POST'])
 @login_required
+@streams_attachments
 def create_post():
     if request.method == 'POST':
+        # 解析表单时附件边接收边写入临时文件，超过大小或类型不允许时立即停止，不会写入数据库
+        try:
+            request.files
+        except (RequestEntityTooLarge, UnsupportedMediaType) as e:
+            flash(e.description)
+            return redirect(url_for('main.create_post'))
+        
         try:
             title = request.form.get('title', '').strip()
             content = request.form.get('content', '').strip()
@@ -144,50 +207,25 @@ def create_post():
             clean_content = bleach.clean(content, tags=allowed_tags, attributes=allowed_attributes)
             
             # 创建帖子
-            post = Post(title=title, content=clean_content, author=current_user, category_id=int(category_id))
+            post = Post(title=title, content=clean_content, user_id=current_user.id, category_id=int(category_id))
+            post.render_content()
             db.session.add(post)
             db.session.flush()  # 获取post.id用于附件关联
+            search_engine.index_post(post)
+            mention_index.update_post_mentions(post)
             
             # 处理文件上传
             if 'file' in request.files:
                 file = request.files['file']
                 if file and file.filename != '':
                     try:
-                        # 检查文件大小 (10MB限制)
-                        file.seek(0, os.SEEK_END)
-                        file_length = file.tell()
-                        file.seek(0)
-                        
-                        if file_length > 10 * 1024 * 1024:  # 10MB
-                            flash('文件大小不能超过10MB')
-                            return redirect(url_for('main.create_post'))
-                        
-                        # 保存文件
-                        filename = secure_filename(file.filename)
-                        upload_folder = current_app.config.get('UPLOAD_FOLDER', os.path.join(current_app.root_path, 'uploads'))
-                        if not os.path.exists(upload_folder):
-                            os.makedirs(upload_folder)
-                        
-                        file_path = os.path.join(upload_folder, filename)
-                        file.save(file_path)
-                        
-                        # 保存文件信息到数据库
-                        attachment = Attachment(
-                            filename=filename,
-                            file_path=file_path,
-                            file_size=file_length,
-                            file_type=file.content_type or 'unknown',
-                            post_id=post.id,
-                            user_id=current_user.id
-                        )
-                        db.session.add(attachment)
-                    except RequestEntityTooLarge:
-                        flash('文件大小超过限制')
-                        return redirect(url_for('main.create_post'))
+                        # 按内容哈希保存文件，相同的文件只保存一份，提交后才移入存储目录
+                        attachment_storage.save(file, post.id, current_user.id)
                     except Exception as e:
                         flash(f'文件上传失败: {str(e)}')
                         return redirect(url_for('main.create_post'))
             
+            page_validators.bump_categories([post.category_id])
             db.session.commit()
             
             flash('帖子发布成功')
@@ -207,8 +245,13 @@ def add_comment(post_id):
     post = Post.query.get_or_404(post_id)
     content = request.form['content']
     
-    comment = Comment(content=content, author=current_user, post=post)
+    comment = Comment(content=content, user_id=current_user.id, post=post)
+    comment.render_content()
     db.session.add(comment)
+    counters.increment_comment_count(post.id)
+    db.session.flush()
+    mention_index.update_comment_mentions(comment)
+    page_validators.bump_categories([post.category_id])
     db.session.commit()
     
     flash('回复成功')
@@ -225,74 +268,16 @@ def profile():
 @login_required
 def edit_profile():
     if request.method == 'POST':
+        try:
+            request.files
+        except (RequestEntityTooLarge, UnsupportedMediaType) as e:
+            flash(e.description)
+            return redirect(url_for('main.edit_profile'))
+        
         username = request.form['username']
         email = request.form['email']
         bio = request.form['bio']
         
-        # 处理头像上传
-        if 'avatar' in request.files:
-            avatar_file = request.files['avatar']
-            if avatar_file and avatar_file.filename != '':
-                # 检查文件类型
-                allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
-                file_ext = avatar_file.filename.rsplit('.', 1)[1].lower() if '.' in avatar_file.filename else ''
-                if file_ext in allowed_extensions:
-                    # 生成文件名：iwz-f-u-uuid.扩展名
-                    filename = f"iwz-f-u-{current_user.user_id}.{file_ext}"
-                    upload_folder = current_app.config.get('UPLOAD_FOLDER', os.path.join(current_app.root_path, 'uploads'))
-                    
-                    # 创建上传目录（如果不存在）
-                    if not os.path.exists(upload_folder):
-                        os.makedirs(upload_folder)
-                    
-                    # 保存并压缩图片
-                    file_path = os.path.join(upload_folder, filename)
-                    
-                    # 如果是图片文件，进行压缩处理
-                    if file_ext in {'png', 'jpg', 'jpeg', 'gif', 'bmp'}:
-                        try:
-                            from PIL import Image
-                            
-                            # 打开图片
-                            image = Image.open(avatar_file)
-                            
-                            # 转换为RGB模式（如果需要）
-                            if image.mode in ('RGBA', 'LA', 'P'):
-                                # 如果是RGBA或LA模式，转换为RGB并处理透明背景
-                                if file_ext == 'jpg' or file_ext == 'jpeg':
-                                    background = Image.new('RGB', image.size, (255, 255, 255))
-                                    background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                                    image = background
-                                else:
-                                    image = image.convert('RGB')
-                            
-                            # 强制压缩到512x512
-                            image = image.resize((512, 512), Image.Resampling.LANCZOS)
-                            
-                            # 保存图片
-                            if file_ext == 'png':
-                                image.save(file_path, 'PNG', optimize=True)
-                            elif file_ext == 'jpg' or file_ext == 'jpeg':
-                                image.save(file_path, 'JPEG', quality=85, optimize=True)
-                            elif file_ext == 'gif':
-                                image.save(file_path, 'GIF', optimize=True)
-                            elif file_ext == 'bmp':
-                                image.save(file_path, 'BMP')
-                                
-                        except Exception as e:
-                            # 如果图片处理失败，直接保存原文件
-                            avatar_file.seek(0)  # 重置文件指针
-                            avatar_file.save(file_path)
-                    else:
-                        # 非图片文件直接保存
-                        avatar_file.save(file_path)
-                    
-                    # 更新用户头像字段
-                    current_user.avatar = filename
-                else:
-                    flash('头像文件格式不支持，仅支持 PNG, JPG, JPEG, GIF, BMP 格式')
-                    return redirect(url_for('main.edit_profile'))
-        
         # 检查用户名是否已存在（排除当前用户）
         existing_user = User.query.filter(User.username == username, User.id != current_user.id).first()
         if existing_user:
@@ -305,12 +290,28 @@ def edit_profile():
             flash('邮箱已被注册')
             return redirect(url_for('main.edit_profile'))
         
+        # 处理头像上传，缩放在后台线程中进行（用户名和邮箱检查通过后再保存文件）
+        old_avatar = current_user.avatar
+        avatar_file = request.files.get('avatar')
+        if avatar_file and avatar_file.filename != '':
+            try:
+                current_user.avatar = avatar_processor.save_upload(avatar_file, current_user.user_id)
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('main.edit_profile'))
+        
         # 更新用户信息
         current_user.username = username
         current_user.email = email
         current_user.bio = bio
+        search_engine.index_user(current_user.load())
+        # 用户名和头像显示在所有版块的帖子和评论中
+        page_validators.bump_categories()
         
         db.session.commit()
+        # 提交成功后再删除旧头像，提交失败时用户仍然使用旧头像
+        if current_user.avatar != old_avatar:
+            avatar_processor.remove(old_avatar)
         
         flash('资料更新成功')
         return redirect(url_for('main.profile'))
@@ -321,8 +322,19 @@ def edit_profile():
 @bp.route('/user/<int:user_id>')
 def user_detail(user_id):
     user = User.query.get_or_404(user_id)
-    posts = Post.query.filter_by(user_id=user_id).order_by(Post.created_at.desc()).all()
-    return render_template('user_detail.html', user=user, posts=posts)
+    posts = keyset_paginate(
+        without_post_bodies(Post.query.filter_by(user_id=user_id)),
+        (Post.created_at, Post.id), request.args.get('cursor'), per_page=10
+    )
+    load_post_aggregates(posts.items)
+    # 最近的回复，连同所属帖子一起加载
+    comments = user.comments.options(
+        db.defer(Comment.content), db.defer(Comment.content_html),
+        db.joinedload(Comment.post).load_only(Post.id, Post.title)
+    ).order_by(
+        Comment.created_at.desc(), Comment.id.desc()
+    ).limit(10).all()
+    return render_template('user_detail.html', user=user, posts=posts, comments=comments)
 
 # 下载附件
 @bp.route('/attachment/<int:attachment_id>')
@@ -330,10 +342,32 @@ def user_detail(user_id):
 def download_attachment(attachment_id):
     attachment = Attachment.query.get_or_404(attachment_id)
     # 检查文件是否存在
-    if not os.path.exists(attachment.file_path):
+    if not os.path.exists(attachment_storage.path(attachment)):
         flash('文件不存在')
         return redirect(request.referrer or url_for('main.index'))
     
-    # 使用send_file发送文件
-    from flask import send_file
-    return send_file(attachment.file_path, as_attachment=True, download_name=attachment.filename)
+    # 按ATTACHMENT_DELIVERY发送文件，支持304和断点续传
+    return attachment_storage.send(attachment)
+
+# 图片附件的缩略图，第一次请求时生成
+@bp.route('/attachment/<int:attachment_id>/thumbnail/<int:size>')
+@login_required
+def attachment_thumbnail(attachment_id, size):
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+    attachment = Attachment.query.get_or_404(attachment_id)
+    if not attachment.is_image():
+        abort(404)
+    try:
+        path = thumbnail_generator.get(attachment, size)
+    except FutureTimeoutError:
+        abort(503)
+    if path is None:
+        abort(404)
+    
+    # 附件内容不会改变，缩略图可以长期缓存
+    response = send_file(path, mimetype='image/webp', max_age=current_app.config.get('THUMBNAIL_MAX_AGE', 30 * 86400))
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
@@ -1,8 +1,20 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from extensions import db
-from models import User, Category, Post, Comment, Tag, Message, Report, Vote, RequestLog
-from datetime import datetime, timedelta
+from models import User, Category, Post, Comment, Tag, Message, Conversation, Mention, Report, Vote, RequestLog, Attachment
+from datetime import date, datetime, timedelta
+from loaders import load_post_aggregates, without_post_bodies
+from pagination import keyset_paginate, keyset_paginate_union
+from stats import get_site_stats, invalidate_site_stats
+from avatars import avatar_processor
+from attachments import attachment_storage
+from daily_stats import load_daily_stats, COUNTERS as DAILY_COUNTERS
+from search_index import search_engine, parse_query, make_snippet
+from rendering import html_to_text
+import counters
+import conversations
+import mention_index
+import page_validators
 import os
 
 # 创建蓝图
@@ -24,11 +36,17 @@ def edit_post(post_id):
         content = request.form['content']
         category_id = request.form['category_id']
         
+        # 原版块和新版块的页面都需要更新
+        page_validators.bump_categories([post.category_id, category_id])
+        
         # 更新帖子
         post.title = title
         post.content = content
         post.category_id = category_id
         post.updated_at = datetime.utcnow()
+        post.render_content()
+        search_engine.index_post(post)
+        mention_index.update_post_mentions(post)
         
         db.session.commit()
         
@@ -54,6 +72,9 @@ def edit_comment(comment_id):
         
         # 更新评论
         comment.content = content
+        comment.render_content()
+        mention_index.update_comment_mentions(comment)
+        page_validators.bump_categories([comment.post.category_id])
         
         db.session.commit()
         
@@ -70,32 +91,34 @@ def search():
     
     users = []
     posts = []
+    highlight_terms = []
+    snippets = {}
     
     if query:
-        # 搜索帖子标题、内容、ID
-        posts = Post.query.filter(
-            db.or_(
-                Post.title.contains(query),
-                Post.content.contains(query),
-                Post.id.contains(query)  # 搜索帖子ID
-            )
-        ).order_by(Post.created_at.desc()).paginate(
-            page=page, per_page=10, error_out=False
-        )
+        # 输入完整的帖子ID时直接跳转到帖子
+        post = db.session.get(Post, query.strip())
+        if post:
+            return redirect(url_for('main.post_detail', post_id=post.id))
         
-        # 搜索用户名称和用户ID
-        users = User.query.filter(
-            db.or_(
-                User.username.contains(query),
-                User.user_id.contains(query)  # 搜索用户ID
-            )
-        ).all()
+        # 全文索引搜索帖子标题和内容，按相关度排序
+        posts = search_engine.search_posts(query, page=page, per_page=10)
+        
+        # 用户ID精确匹配，用户名走全文索引
+        user = User.query.filter_by(user_id=query.strip()).first()
+        users = [user] if user else search_engine.search_users(query)
+        
+        # 摘要取正文中第一个命中位置附近的文字
+        terms, highlight_terms = parse_query(query)
+        for post in posts.items:
+            snippets[post.id] = make_snippet(html_to_text(post.get_content_html()), highlight_terms)
     else:
         posts = Post.query.order_by(Post.created_at.desc()).paginate(
             page=page, per_page=10, error_out=False
         )
     
-    return render_template('search.html', posts=posts, users=users, query=query)
+    load_post_aggregates(posts.items)
+    return render_template('search.html', posts=posts, users=users, query=query,
+                          highlight_terms=highlight_terms, snippets=snippets)
 
 # 后台管理页面 - 仪表板
 @bp.route('/admin')
@@ -105,10 +128,11 @@ def admin_dashboard():
         flash('您没有权限访问此页面')
         return redirect(url_for('main.index'))
     
-    # 统计数据
-    user_count = User.query.count()
-    post_count = Post.query.count()
-    comment_count = Comment.query.count()
+    # 统计数据，总数与首页共用缓存，待处理举报数实时查询
+    stats = get_site_stats()
+    user_count = stats['user_count']
+    post_count = stats['post_count']
+    comment_count = stats['comment_count']
     report_count = Report.query.filter_by(status='pending').count()
     
     # 最近的帖子
@@ -135,18 +159,24 @@ def admin_logs():
     
     # 获取过滤参数
     days = request.args.get('days', 7, type=int)
-    page = request.args.get('page', 1, type=int)
     
     # 计算日期范围
     from datetime import datetime, timedelta
     start_date = datetime.utcnow() - timedelta(days=days)
     
-    # 查询日志
-    logs = RequestLog.query.filter(RequestLog.timestamp >= start_date).order_by(
-        RequestLog.timestamp.desc()
-    ).paginate(page=page, per_page=20, error_out=False)
+    # 查询日志，按 (timestamp, id) 游标分页，翻页不使用OFFSET和COUNT
+    logs = keyset_paginate(
+        RequestLog.query.filter(RequestLog.timestamp >= start_date),
+        (RequestLog.timestamp, RequestLog.id), request.args.get('cursor')
+    )
+    
+    # 各端点的统计从汇总表读取，不扫描原始日志
+    from log_rollups import load_endpoint_summary
+    summary_period, endpoint_summary = load_endpoint_summary(start_date)
     
-    return render_template('admin/logs.html', logs=logs)
+    return render_template('admin/logs.html', logs=logs, days=days,
+                          summary_period=summary_period,
+                          endpoint_summary=endpoint_summary)
 
 # 后台管理页面 - 用户管理
 @bp.route('/admin/users')
@@ -183,20 +213,42 @@ def admin_delete_user(user_id):
         flash('不能删除自己')
         return redirect(url_for('advanced.admin_users'))
     
+    # 记录受影响的帖子和评论，删除后重新计算它们的计数
+    affected_post_ids = {row.post_id for row in db.session.query(Comment.post_id).filter_by(user_id=user.id).distinct()}
+    affected_comment_ids = set()
+    for row in db.session.query(Vote.voted_type, Vote.voted_id).filter_by(user_id=user.id).distinct():
+        if row.voted_type == 'post':
+            affected_post_ids.add(row.voted_id)
+        elif row.voted_type == 'comment':
+            affected_comment_ids.add(row.voted_id)
+    
+    # 从搜索索引中移除用户和用户的帖子
+    search_engine.remove_posts([row.id for row in db.session.query(Post.id).filter_by(user_id=user.id)])
+    search_engine.remove_users([user.id])
+    
     # 删除用户相关数据
+    # 删除与用户及其帖子有关的@提醒
+    mention_index.remove_user(user.id)
+    
+    # 删除用户帖子的附件，文件在提交后按引用数清理
+    released_blobs = attachment_storage.release(
+        Attachment.post_id.in_(db.session.query(Post.id).filter_by(user_id=user.id))
+    )
+    
     # 删除用户的帖子
     Post.query.filter_by(user_id=user.id).delete()
     
     # 删除用户的评论
     Comment.query.filter_by(user_id=user.id).delete()
     
-    # 删除用户的消息
+    # 删除用户的消息和对话
     Message.query.filter(
         db.or_(
             Message.sender_id == user.id,
             Message.recipient_id == user.id
         )
     ).delete()
+    conversations.remove_user(user.id)
     
     # 删除用户的举报
     Report.query.filter_by(reporter_id=user.id).delete()
@@ -204,9 +256,19 @@ def admin_delete_user(user_id):
     # 删除用户的投票
     Vote.query.filter_by(user_id=user.id).delete()
     
+    # 在同一事务中修正计数
+    counters.recount_posts(affected_post_ids)
+    counters.recount_comments(affected_comment_ids)
+    # 用户的帖子、评论和投票可能分布在所有版块
+    page_validators.bump_categories()
+    
     # 删除用户
+    avatar = user.avatar
     db.session.delete(user)
     db.session.commit()
+    invalidate_site_stats()
+    avatar_processor.remove(avatar)
+    attachment_storage.collect(released_blobs)
     
     flash('用户删除成功')
     return redirect(url_for('advanced.admin_users'))
@@ -241,7 +303,10 @@ def admin_create_category():
         else:
             category = Category(name=name, description=description)
             db.session.add(category)
+            db.session.flush()
+            page_validators.bump_categories([category.id])
             db.session.commit()
+            invalidate_site_stats()
             flash('版块创建成功')
     else:
         flash('版块名称不能为空')
@@ -268,6 +333,7 @@ def admin_edit_category(category_id):
         else:
             category.name = name
             category.description = description
+            page_validators.bump_categories([category.id])
             db.session.commit()
             flash('版块更新成功')
     else:
@@ -290,7 +356,10 @@ def admin_delete_category(category_id):
         flash('无法删除有帖子的版块')
     else:
         db.session.delete(category)
+        # 其他页面的版块列表中不再包含此版块
+        page_validators.bump_categories()
         db.session.commit()
+        invalidate_site_stats()
         flash('版块删除成功')
     
     return redirect(url_for('advanced.admin_categories'))
@@ -320,6 +389,9 @@ def admin_delete_post(post_id):
     
     post = Post.query.get_or_404(post_id)
     
+    # 删除帖子和评论中的@提醒
+    mention_index.remove_post(post.id)
+    
     # 删除帖子相关的评论
     Comment.query.filter_by(post_id=post.id).delete()
     
@@ -329,9 +401,16 @@ def admin_delete_post(post_id):
     # 删除帖子相关的投票
     Vote.query.filter_by(voted_type='post', voted_id=post.id).delete()
     
+    # 删除帖子的附件，文件在提交后按引用数清理
+    released_blobs = attachment_storage.release(Attachment.post_id == post.id)
+    
     # 删除帖子
+    search_engine.remove_posts([post.id])
+    page_validators.bump_categories([post.category_id])
     db.session.delete(post)
     db.session.commit()
+    invalidate_site_stats()
+    attachment_storage.collect(released_blobs)
     
     flash('帖子删除成功')
     return redirect(url_for('advanced.admin_posts'))
@@ -389,47 +468,47 @@ def admin_analytics():
         flash('您没有权限访问此页面')
         return redirect(url_for('main.index'))
     
-    # 用户增长统计
-    user_stats_result = db.session.query(
-        db.func.date(User.created_at).label('date'),
-        db.func.count(User.id).label('count')
-    ).group_by(db.func.date(User.created_at)).all()
-    
-    # 转换为字典列表
-    user_stats = [{'date': str(stat.date), 'count': stat.count} for stat in user_stats_result]
-    
-    # 帖子增长统计
-    post_stats_result = db.session.query(
-        db.func.date(Post.created_at).label('date'),
-        db.func.count(Post.id).label('count')
-    ).group_by(db.func.date(Post.created_at)).all()
-    
-    # 转换为字典列表
-    post_stats = [{'date': str(stat.date), 'count': stat.count} for stat in post_stats_result]
-    
-    # 评论增长统计
-    comment_stats_result = db.session.query(
-        db.func.date(Comment.created_at).label('date'),
-        db.func.count(Comment.id).label('count')
-    ).group_by(db.func.date(Comment.created_at)).all()
-    
-    # 转换为字典列表
-    comment_stats = [{'date': str(stat.date), 'count': stat.count} for stat in comment_stats_result]
+    # 日期范围，默认最近30天，最长一年
+    today = datetime.utcnow().date()
+    try:
+        end_day = date.fromisoformat(request.args.get('end', ''))
+    except ValueError:
+        end_day = today
+    try:
+        start_day = date.fromisoformat(request.args.get('start', ''))
+    except ValueError:
+        start_day = end_day - timedelta(days=29)
+    end_day = min(end_day, today)
+    start_day = max(min(start_day, end_day), end_day - timedelta(days=365))
+    category_id = request.args.get('category_id', 0, type=int)
+    
+    # 每日统计来自daily_stats表，读取量只与日期范围有关
+    daily = load_daily_stats(start_day, end_day, category_id)
+    totals = {field: sum(day[field] for day in daily) for field in DAILY_COUNTERS}
     
     # 版块数据
     categories = Category.query.all()
     
+    # 每日请求量，来自请求日志的天汇总
+    from log_rollups import load_daily_request_counts
+    request_stats = load_daily_request_counts(datetime.combine(start_day, datetime.min.time()),
+                                              datetime.combine(end_day + timedelta(days=1), datetime.min.time()))
+    
     return render_template('admin/analytics.html', 
-                          user_stats=user_stats,
-                          post_stats=post_stats,
-                          comment_stats=comment_stats,
+                          daily=daily,
+                          totals=totals,
+                          site_stats=get_site_stats(),
+                          start_day=start_day,
+                          end_day=end_day,
+                          category_id=category_id,
+                          request_stats=request_stats,
                           categories=categories)
 
 # 好友系统页面 - 好友列表
 @bp.route('/friends')
 @login_required
 def friends():
-    friends = current_user.friends.all()
+    friends = keyset_paginate(current_user.friends, (User.created_at, User.id), request.args.get('cursor'))
     return render_template('friends.html', friends=friends)
 
 # 添加好友
@@ -464,35 +543,11 @@ def remove_friend(user_id):
 @bp.route('/messages')
 @login_required
 def messages():
-    # 获取与当前用户相关的消息
-    messages = Message.query.filter(
-        db.or_(
-            Message.sender_id == current_user.id,
-            Message.recipient_id == current_user.id
-        )
-    ).order_by(Message.created_at.desc()).all()
-    
-    # 获取唯一的对话用户
-    user_ids = set()
-    for msg in messages:
-        if msg.sender_id != current_user.id:
-            user_ids.add(msg.sender_id)
-        if msg.recipient_id != current_user.id:
-            user_ids.add(msg.recipient_id)
-    
-    users = User.query.filter(User.id.in_(user_ids)).all()
-    
-    # 添加获取最后消息的函数
-    def get_last_message(user1_id, user2_id):
-        last_message = Message.query.filter(
-            db.or_(
-                db.and_(Message.sender_id == user1_id, Message.recipient_id == user2_id),
-                db.and_(Message.sender_id == user2_id, Message.recipient_id == user1_id)
-            )
-        ).order_by(Message.created_at.desc()).first()
-        return last_message
-    
-    return render_template('messages.html', users=users, get_last_message=get_last_message)
+    # 从对话摘要表读取，按最后消息时间排序分页
+    query = Conversation.query.filter_by(user_id=current_user.id).options(db.joinedload(Conversation.partner))
+    conversations_page = keyset_paginate(query, (Conversation.last_message_at, Conversation.id),
+                                         request.args.get('cursor'))
+    return render_template('messages.html', conversations=conversations_page)
 
 # 私信聊天详情页面
 @bp.route('/messages/<int:user_id>')
@@ -500,22 +555,22 @@ def messages():
 def message_detail(user_id):
     user = User.query.get_or_404(user_id)
     
-    # 获取对话消息
-    messages = Message.query.filter(
-        db.or_(
-            db.and_(Message.sender_id == current_user.id, Message.recipient_id == user.id),
-            db.and_(Message.sender_id == user.id, Message.recipient_id == current_user.id)
-        )
-    ).order_by(Message.created_at.asc()).all()
+    # 从最新的消息开始分页加载，两个方向的消息分别沿索引读取
+    page = keyset_paginate_union(Message, [
+        Message.query.filter_by(sender_id=current_user.id, recipient_id=user.id),
+        Message.query.filter_by(sender_id=user.id, recipient_id=current_user.id),
+    ], (Message.created_at, Message.id), request.args.get('cursor'), per_page=50)
     
-    # 标记为已读
-    for msg in messages:
-        if msg.recipient_id == current_user.id:
-            msg.is_read = True
+    # 用一条UPDATE把对方发来的未读消息标记为已读；is_read写成常量条件，SQLite才能使用部分索引
+    Message.query.filter(
+        Message.recipient_id == current_user.id, Message.sender_id == user.id, Message.is_read == db.false()
+    ).update({Message.is_read: True}, synchronize_session=False)
+    conversations.mark_read(current_user.id, user.id)
     
     db.session.commit()
     
-    return render_template('message_detail.html', user=user, messages=messages)
+    # 页面上按时间正序显示
+    return render_template('message_detail.html', user=user, page=page, messages=list(reversed(page.items)))
 
 # 发送私信
 @bp.route('/send_message/<int:user_id>', methods=['POST'])
@@ -531,6 +586,8 @@ def send_message(user_id):
     )
     
     db.session.add(message)
+    db.session.flush()
+    conversations.record_message(message)
     db.session.commit()
     
     flash('消息已发送')
@@ -540,14 +597,14 @@ def send_message(user_id):
 @bp.route('/following')
 @login_required
 def following():
-    following = current_user.followed.all()
+    following = keyset_paginate(current_user.followed, (User.created_at, User.id), request.args.get('cursor'))
     return render_template('following.html', following=following)
 
 # 粉丝列表页面
 @bp.route('/followers')
 @login_required
 def followers():
-    followers = current_user.followers.all()
+    followers = keyset_paginate(current_user.followers, (User.created_at, User.id), request.args.get('cursor'))
     return render_template('followers.html', followers=followers)
 
 # 关注用户
@@ -582,8 +639,8 @@ def unfollow(user_id):
 @bp.route('/blacklist')
 @login_required
 def blacklist():
-    blocked = current_user.blocked.all()
-    return render_template('blacklist.html', blocked=blocked)
+    blocked = keyset_paginate(current_user.blocked, (User.created_at, User.id), request.args.get('cursor'))
+    return render_template('blacklist.html', blocked_users=blocked)
 
 # 加入黑名单
 @bp.route('/block/<int:user_id>', methods=['POST'])
@@ -614,7 +671,7 @@ def unblock(user_id):
     return redirect(url_for('advanced.blacklist'))
 
 # 点赞/踩功能
-@bp.route('/vote/<string:entity_type>/<entity_id>/<int:vote_type>', methods=['POST'])
+@bp.route('/vote/<string:entity_type>/<entity_id>/<int(signed=True):vote_type>', methods=['POST'])
 @login_required
 def vote(entity_type, entity_id, vote_type):
     # 验证投票类型
@@ -635,9 +692,11 @@ def vote(entity_type, entity_id, vote_type):
         
         if existing_vote:
             # 更新现有投票
+            old_vote = existing_vote.vote_type
             existing_vote.vote_type = vote_type
         else:
             # 创建新投票
+            old_vote = 0
             vote = Vote(
                 user_id=current_user.id,
                 voted_type='post',
@@ -646,6 +705,9 @@ def vote(entity_type, entity_id, vote_type):
             )
             db.session.add(vote)
         
+        # 在同一事务中更新计数
+        counters.apply_vote(Post, post.id, old_vote, vote_type)
+        page_validators.bump_categories([post.category_id])
         db.session.commit()
         flash('投票成功')
         
@@ -662,9 +724,11 @@ def vote(entity_type, entity_id, vote_type):
         
         if existing_vote:
             # 更新现有投票
+            old_vote = existing_vote.vote_type
             existing_vote.vote_type = vote_type
         else:
             # 创建新投票
+            old_vote = 0
             vote = Vote(
                 user_id=current_user.id,
                 voted_type='comment',
@@ -673,6 +737,9 @@ def vote(entity_type, entity_id, vote_type):
             )
             db.session.add(vote)
         
+        # 在同一事务中更新计数
+        counters.apply_vote(Comment, comment.id, old_vote, vote_type)
+        page_validators.bump_categories([comment.post.category_id])
         db.session.commit()
         flash('投票成功')
         
@@ -685,7 +752,10 @@ def vote(entity_type, entity_id, vote_type):
 @bp.route('/favorites')
 @login_required
 def favorites():
-    favorites = current_user.favorites.order_by(Post.created_at.desc()).all()
+    favorites = keyset_paginate(
+        without_post_bodies(current_user.favorites), (Post.created_at, Post.id), request.args.get('cursor')
+    )
+    load_post_aggregates(favorites.items)
     return render_template('favorites.html', favorites=favorites)
 
 # 添加收藏
@@ -732,11 +802,16 @@ def share_post(post_id):
     new_post = Post(
         title=f"转发: {post.title}",
         content=shared_content,
-        author=current_user,
+        user_id=current_user.id,
         category=post.category
     )
+    new_post.render_content()
     
     db.session.add(new_post)
+    db.session.flush()
+    search_engine.index_post(new_post)
+    mention_index.update_post_mentions(new_post)
+    page_validators.bump_categories([new_post.category_id])
     db.session.commit()
     
     flash('帖子已转发')
@@ -746,37 +821,66 @@ def share_post(post_id):
 @bp.route('/mentions')
 @login_required
 def mentions():
-    # 这里需要实现@提醒的逻辑
-    # 由于简化实现，我们只显示最近的评论
-    comments = Comment.query.filter(
-        Comment.content.contains(f'@{current_user.username}')
-    ).order_by(Comment.created_at.desc()).limit(20).all()
+    # 从提醒表读取，按时间倒序分页
+    query = Mention.query.filter_by(user_id=current_user.id).options(
+        db.joinedload(Mention.author),
+        db.joinedload(Mention.post).load_only(Post.id, Post.title, Post.content_preview),
+        db.joinedload(Mention.comment).load_only(Comment.id, Comment.content_preview),
+    )
+    page = keyset_paginate(query, (Mention.created_at, Mention.id), request.args.get('cursor'))
+    unread_count = mention_index.unread_count(current_user.id)
+    
+    # 本页显示后标记为已读，页面上仍按读取前的状态显示
+    unread_ids = {mention.id for mention in page if not mention.is_read}
+    if unread_ids:
+        mention_index.mark_read(current_user.id, unread_ids)
+        db.session.commit()
     
-    return render_template('mentions.html', comments=comments)
+    return render_template('mentions.html', mentions=page, unread_ids=unread_ids, unread_count=unread_count)
 
 # 标签系统页面
 @bp.route('/tags')
 def tags():
+    # 帖子的增删改都会增加版块版本，标签统计未变化时不重新查询
+    version, changed_at = page_validators.site_version()
+    etag = page_validators.page_etag('tags', version)
+    response = page_validators.not_modified(etag, changed_at)
+    if response is not None:
+        return response
+    
     # 获取标签及其帖子数量
     tag_stats = db.session.query(
         Tag,
         db.func.count(Post.id).label('post_count')
     ).join(Post, Tag.posts).group_by(Tag.id).all()
     
-    return render_template('tags.html', tag_stats=tag_stats)
+    return page_validators.with_validators(render_template('tags.html', tag_stats=tag_stats), etag, changed_at)
 
 # 标签详情页面
 @bp.route('/tag/<int:tag_id>')
 def tag_detail(tag_id):
     tag = Tag.query.get_or_404(tag_id)
-    posts = tag.posts.order_by(Post.created_at.desc()).all()
+    posts = keyset_paginate(without_post_bodies(tag.posts), (Post.created_at, Post.id), request.args.get('cursor'))
+    load_post_aggregates(posts.items)
     return render_template('tag_detail.html', tag=tag, posts=posts)
 
 # 精华帖页面
 @bp.route('/essence')
 def essence():
-    posts = Post.query.filter_by(is_essence=True).order_by(Post.created_at.desc()).all()
-    return render_template('essence.html', posts=posts)
+    version, changed_at = page_validators.site_version()
+    period, period_start = page_validators.stats_period()
+    etag = page_validators.page_etag('essence', version, period)
+    last_modified = page_validators.latest(changed_at, period_start)
+    response = page_validators.not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    
+    posts = keyset_paginate(
+        without_post_bodies(Post.query.filter_by(is_essence=True)),
+        (Post.created_at, Post.id), request.args.get('cursor')
+    )
+    load_post_aggregates(posts.items)
+    return page_validators.with_validators(render_template('essence.html', posts=posts), etag, last_modified)
 
 # 用户投票页面 - 发起投票
 @bp.route('/create_vote', methods=['GET', 'POST'])
@@ -823,8 +927,13 @@ def create_vote():
             user_id=current_user.id,
             category_id=category_id
         )
+        post.render_content()
         
         db.session.add(post)
+        db.session.flush()
+        search_engine.index_post(post)
+        mention_index.update_post_mentions(post)
+        page_validators.bump_categories([category_id])
         db.session.commit()
         
         flash('投票创建成功')
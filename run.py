@@ -1,12 +1,15 @@
 import sys
 from waitress import serve
 from app import create_app
+import database
 
 def main():
     # 检查是否启用调试模式
     debug_mode = '-debug' in sys.argv
     
     app = create_app()
+    with app.app_context():
+        print(database.describe())
     
     if debug_mode:
         print("启动IWZ-Forum论坛系统 (调试模式)...")
@@ -0,0 +1,435 @@
+import bisect
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from markupsafe import Markup, escape
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from extensions import db
+from models import Post, User, SearchDocument
+
+# 中日韩统一表意文字逐字切分，其余字母数字按词切分
+_CJK = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_RUN_RE = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+_CJK_RE = re.compile(f'[{_CJK}]')
+
+# BM25参数
+_K1 = 1.2
+_B = 0.75
+
+def tokenize(value):
+    """切分待索引的文本：中文输出单字和相邻两字，其余按词输出"""
+    tokens = []
+    for run in _RUN_RE.findall((value or '').lower()):
+        if _CJK_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+def parse_query(query):
+    """切分搜索词，返回 (检索项列表, 高亮词列表)，检索项为 (词, 是否前缀匹配)"""
+    terms = []
+    highlights = []
+    for run in _RUN_RE.findall((query or '').lower()):
+        highlights.append(run)
+        if not _CJK_RE.match(run):
+            # 字母数字按前缀匹配，输入 "flas" 也能找到 "flask"
+            terms.append((run, True))
+        elif len(run) == 1:
+            terms.append((run, False))
+        else:
+            terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    terms = list(dict.fromkeys(terms))
+    highlights.extend(term for term, prefix in terms if term not in highlights)
+    return terms, highlights
+
+def _highlight_pattern(terms):
+    terms = sorted({term for term in terms if term}, key=len, reverse=True)
+    if not terms:
+        return None
+    return re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+
+def highlight(value, terms):
+    """转义文本并用<mark>标出搜索词"""
+    value = value or ''
+    pattern = _highlight_pattern(terms or [])
+    if pattern is None:
+        return escape(value)
+
+    parts = []
+    last = 0
+    for match in pattern.finditer(value):
+        parts.append(escape(value[last:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group())
+        last = match.end()
+    parts.append(escape(value[last:]))
+    return Markup('').join(parts)
+
+def make_snippet(value, terms, length=120):
+    """截取第一个命中位置附近的一段文字作为摘要，并高亮搜索词"""
+    value = ' '.join((value or '').split())
+    pattern = _highlight_pattern(terms)
+    match = pattern.search(value) if pattern else None
+    start = max(0, match.start() - length // 4) if match else 0
+
+    snippet = highlight(value[start:start + length], terms)
+    if start > 0:
+        snippet = Markup('...') + snippet
+    if start + length < len(value):
+        snippet += Markup('...')
+    return snippet
+
+class SearchKind:
+    """一类可搜索的对象：模型、参与索引的列及各列的排序权重"""
+
+    def __init__(self, name, model, columns, weights, key_type=str):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.fields = [column.key for column in columns]
+        self.weights = weights
+        self.key_type = key_type
+        self.table = f'{name}_search'
+
+    def iter_batches(self, batch_size=500, session=None):
+        # 按主键分批读取，避免一次性加载全部内容
+        session = session or db.session
+        last_id = None
+        while True:
+            query = session.query(self.model.id, *self.columns).order_by(self.model.id)
+            if last_id is not None:
+                query = query.filter(self.model.id > last_id)
+            rows = query.limit(batch_size).all()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [(str(row[0]), tuple(row[1:])) for row in rows]
+
+    def load(self, doc_ids):
+        # 按检索结果的顺序返回对象
+        keys = [self.key_type(doc_id) for doc_id in doc_ids]
+        if not keys:
+            return []
+        objects = {obj.id: obj for obj in self.model.query.filter(self.model.id.in_(keys))}
+        return [objects[key] for key in keys if key in objects]
+
+class Fts5Backend:
+    """SQLite FTS5 全文索引，分词在Python中完成，索引写入与业务数据在同一事务中提交"""
+    name = 'fts5'
+
+    def __init__(self, kinds):
+        self.kinds = kinds
+
+    def create_tables(self, conn):
+        for kind in self.kinds.values():
+            columns = ', '.join(kind.fields)
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {kind.table} USING fts5({columns}, tokenize='unicode61')"
+            ))
+
+    def _insert(self, kind, rows):
+        columns = ', '.join(kind.fields)
+        binds = ', '.join(f':{field}' for field in kind.fields)
+        db.session.execute(text(f'INSERT INTO {kind.table} (rowid, {columns}) VALUES (:rowid, {binds})'), [
+            {'rowid': rowid, **{field: ' '.join(tokenize(value)) for field, value in zip(kind.fields, values)}}
+            for rowid, values in rows
+        ])
+
+    def _delete(self, kind, rowids):
+        stmt = text(f'DELETE FROM {kind.table} WHERE rowid IN :rowids').bindparams(
+            db.bindparam('rowids', expanding=True)
+        )
+        db.session.execute(stmt, {'rowids': list(rowids)})
+
+    def upsert(self, kind, doc_id, values):
+        rowid = db.session.query(SearchDocument.id).filter_by(kind=kind.name, doc_id=doc_id).scalar()
+        if rowid is None:
+            document = SearchDocument(kind=kind.name, doc_id=doc_id)
+            db.session.add(document)
+            db.session.flush()
+            rowid = document.id
+        else:
+            self._delete(kind, [rowid])
+        self._insert(kind, [(rowid, values)])
+
+    def remove(self, kind, doc_ids):
+        rowids = [row.id for row in db.session.query(SearchDocument.id).filter(
+            SearchDocument.kind == kind.name, SearchDocument.doc_id.in_(doc_ids)
+        )]
+        if rowids:
+            self._delete(kind, rowids)
+            SearchDocument.query.filter(SearchDocument.id.in_(rowids)).delete(synchronize_session=False)
+
+    def search(self, kind, terms, limit, offset):
+        # 每个检索项加引号，避免用户输入被当作FTS5查询语法
+        match = ' '.join(
+            '"{}"{}'.format(term.replace('"', '""'), '*' if prefix else '') for term, prefix in terms
+        )
+        weights = ', '.join(str(weight) for weight in kind.weights)
+        params = {'match': match, 'limit': limit, 'offset': offset}
+        doc_ids = db.session.execute(text(
+            f'SELECT d.doc_id FROM {kind.table} JOIN search_document d ON d.id = {kind.table}.rowid '
+            f'WHERE {kind.table} MATCH :match ORDER BY bm25({kind.table}, {weights}) LIMIT :limit OFFSET :offset'
+        ), params).scalars().all()
+        total = db.session.execute(
+            text(f'SELECT count(*) FROM {kind.table} WHERE {kind.table} MATCH :match'), params
+        ).scalar()
+        return doc_ids, total
+
+    def rebuild(self, kind, batch_size=500):
+        db.session.execute(text(f'DELETE FROM {kind.table}'))
+        SearchDocument.query.filter_by(kind=kind.name).delete(synchronize_session=False)
+
+        count = 0
+        for batch in kind.iter_batches(batch_size):
+            db.session.execute(SearchDocument.__table__.insert(), [
+                {'kind': kind.name, 'doc_id': doc_id} for doc_id, values in batch
+            ])
+            rowids = dict(db.session.query(SearchDocument.doc_id, SearchDocument.id).filter(
+                SearchDocument.kind == kind.name, SearchDocument.doc_id.in_([doc_id for doc_id, values in batch])
+            ).all())
+            self._insert(kind, [(rowids[doc_id], values) for doc_id, values in batch])
+            count += len(batch)
+
+        # 合并索引段，提高之后的查询速度
+        db.session.execute(text(f"INSERT INTO {kind.table} ({kind.table}) VALUES ('optimize')"))
+        return count
+
+class _InvertedIndex:
+    def __init__(self, weights):
+        self.weights = weights
+        self.postings = defaultdict(dict)   # 词 -> {文档: 加权词频}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self._vocabulary = None             # 排序后的词表，用于前缀匹配
+
+    def add(self, doc_id, values):
+        self.remove(doc_id)
+        frequencies = Counter()
+        length = 0
+        for weight, value in zip(self.weights, values):
+            tokens = tokenize(value)
+            length += len(tokens)
+            for token in tokens:
+                frequencies[token] += weight
+
+        for term, frequency in frequencies.items():
+            if term not in self.postings:
+                self._vocabulary = None
+            self.postings[term][doc_id] = frequency
+        self.doc_terms[doc_id] = list(frequencies)
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            documents = self.postings[term]
+            documents.pop(doc_id, None)
+            if not documents:
+                del self.postings[term]
+                self._vocabulary = None
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def _expand(self, term, prefix):
+        if not prefix:
+            return [term] if term in self.postings else []
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        position = bisect.bisect_left(self._vocabulary, term)
+        expanded = []
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(term):
+            expanded.append(self._vocabulary[position])
+            position += 1
+        return expanded
+
+    def search(self, terms, limit, offset):
+        total_docs = len(self.doc_lengths)
+        if not total_docs:
+            return [], 0
+        average_length = self.total_length / total_docs or 1
+
+        # 所有检索项都命中的文档才计入结果，得分为各检索项的BM25之和
+        scores = None
+        for term, prefix in terms:
+            matches = defaultdict(float)
+            for expanded in self._expand(term, prefix):
+                for doc_id, frequency in self.postings[expanded].items():
+                    matches[doc_id] += frequency
+            if scores is not None:
+                matches = {doc_id: frequency for doc_id, frequency in matches.items() if doc_id in scores}
+            if not matches:
+                return [], 0
+
+            idf = math.log(1 + (total_docs - len(matches) + 0.5) / (len(matches) + 0.5))
+            term_scores = {
+                doc_id: idf * frequency * (_K1 + 1) / (
+                    frequency + _K1 * (1 - _B + _B * self.doc_lengths[doc_id] / average_length)
+                )
+                for doc_id, frequency in matches.items()
+            }
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc_id: scores[doc_id] + score for doc_id, score in term_scores.items()}
+
+        ranked = sorted(scores, key=lambda doc_id: -scores[doc_id])
+        return ranked[offset:offset + limit], len(ranked)
+
+class MemoryBackend:
+    """纯Python倒排索引，用于不支持FTS5的环境。
+    索引保存在进程内存中，首次搜索时从数据库建立，之后在事务提交后增量更新"""
+    name = 'memory'
+
+    def __init__(self, kinds):
+        self.kinds = kinds
+        self._indexes = {}
+        self._lock = threading.RLock()
+        if not event.contains(db.session, 'after_commit', _apply_pending_updates):
+            event.listen(db.session, 'after_commit', _apply_pending_updates)
+            event.listen(db.session, 'after_transaction_end', _discard_pending_updates)
+
+    def _index(self, kind):
+        index = self._indexes.get(kind.name)
+        if index is None:
+            index = _InvertedIndex(kind.weights)
+            # 使用独立的会话读取，只索引已提交的内容
+            with Session(db.engine) as session:
+                for batch in kind.iter_batches(session=session):
+                    for doc_id, values in batch:
+                        index.add(doc_id, values)
+            self._indexes[kind.name] = index
+        return index
+
+    def _stage(self, kind, updates):
+        # 暂存到会话中，事务提交后再写入索引，回滚时丢弃
+        db.session.info.setdefault('pending_search_updates', []).append((self, kind, updates))
+
+    def _apply(self, kind, updates):
+        with self._lock:
+            # 尚未建立的索引在首次搜索时会从数据库读到最新内容
+            index = self._indexes.get(kind.name)
+            if index is None:
+                return
+            for doc_id, values in updates:
+                if values is None:
+                    index.remove(doc_id)
+                else:
+                    index.add(doc_id, values)
+
+    def upsert(self, kind, doc_id, values):
+        self._stage(kind, [(doc_id, values)])
+
+    def remove(self, kind, doc_ids):
+        self._stage(kind, [(doc_id, None) for doc_id in doc_ids])
+
+    def search(self, kind, terms, limit, offset):
+        with self._lock:
+            return self._index(kind).search(terms, limit, offset)
+
+    def rebuild(self, kind, batch_size=500):
+        with self._lock:
+            self._indexes.pop(kind.name, None)
+            return len(self._index(kind).doc_lengths)
+
+class SearchPagination(Pagination):
+    """搜索结果分页，与 Query.paginate 返回的对象用法相同"""
+
+    def _query_items(self):
+        kind = self._query_args['kind']
+        terms = self._query_args['terms']
+        if not terms:
+            self._total = 0
+            return []
+        doc_ids, self._total = self._query_args['backend'].search(kind, terms, self.per_page, self._query_offset)
+        return kind.load(doc_ids)
+
+    def _query_count(self):
+        return self._total
+
+class SearchEngine:
+    def __init__(self):
+        self.backend = None
+        self.kinds = {
+            'post': SearchKind('post', Post, (Post.title, Post.content), (10.0, 1.0)),
+            'user': SearchKind('user', User, (User.username,), (1.0,), key_type=int),
+        }
+
+    def init_app(self, app):
+        choice = app.config.get('SEARCH_BACKEND', 'auto')
+        with app.app_context():
+            self.backend = self._create_backend(choice)
+        app.add_template_filter(highlight)
+
+    def _create_backend(self, choice):
+        if choice != 'memory' and db.engine.dialect.name == 'sqlite':
+            backend = Fts5Backend(self.kinds)
+            try:
+                with db.engine.begin() as conn:
+                    backend.create_tables(conn)
+                return backend
+            except OperationalError:
+                # SQLite编译时未启用FTS5
+                if choice == 'fts5':
+                    raise
+        elif choice == 'fts5':
+            raise RuntimeError('FTS5全文索引只支持SQLite数据库')
+        return MemoryBackend(self.kinds)
+
+    def index_post(self, post):
+        if post.id is None:
+            db.session.flush()
+        self.backend.upsert(self.kinds['post'], str(post.id), (post.title, post.content))
+
+    def index_user(self, user):
+        if user.id is None:
+            db.session.flush()
+        self.backend.upsert(self.kinds['user'], str(user.id), (user.username,))
+
+    def remove_posts(self, post_ids):
+        post_ids = [str(post_id) for post_id in post_ids]
+        if post_ids:
+            self.backend.remove(self.kinds['post'], post_ids)
+
+    def remove_users(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        if user_ids:
+            self.backend.remove(self.kinds['user'], user_ids)
+
+    def search_posts(self, query, page=1, per_page=10):
+        terms, _ = parse_query(query)
+        return SearchPagination(page=page, per_page=per_page, error_out=False,
+                                backend=self.backend, kind=self.kinds['post'], terms=terms)
+
+    def search_users(self, query, limit=20):
+        terms, _ = parse_query(query)
+        if not terms:
+            return []
+        kind = self.kinds['user']
+        doc_ids, _ = self.backend.search(kind, terms, limit, 0)
+        return kind.load(doc_ids)
+
+    def rebuild(self, batch_size=500):
+        return {name: self.backend.rebuild(kind, batch_size) for name, kind in self.kinds.items()}
+
+search_engine = SearchEngine()
+
+def _apply_pending_updates(session):
+    # 释放保存点时也会触发after_commit，只处理顶层事务的提交
+    if session.in_nested_transaction():
+        return
+    for backend, kind, updates in session.info.pop('pending_search_updates', []):
+        backend._apply(kind, updates)
+
+def _discard_pending_updates(session, transaction):
+    # 顶层事务回滚或关闭会话时，未提交的修改不写入索引
+    if transaction.parent is None:
+        session.info.pop('pending_search_updates', None)
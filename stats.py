@@ -0,0 +1,33 @@
+from cache import TTLCache
+from extensions import db
+from models import User, Category, Post, Comment
+
+# 首页和后台共用的全站统计，过期后由一个请求重新统计
+stats_cache = TTLCache(ttl=60)
+
+def init_app(app):
+    stats_cache.ttl = app.config.get('SITE_STATS_TTL', 60)
+
+def _count(model):
+    return db.select(db.func.count()).select_from(model).scalar_subquery()
+
+def _load_site_stats():
+    # 各表总数合并为一次查询
+    row = db.session.execute(db.select(
+        _count(Post).label('post_count'),
+        _count(Comment).label('comment_count'),
+        _count(User).label('user_count'),
+        _count(Category).label('category_count'),
+    )).one()
+    stats = dict(row._mapping)
+    stats['category_post_counts'] = dict(
+        db.session.query(Post.category_id, db.func.count(Post.id)).group_by(Post.category_id).all()
+    )
+    return stats
+
+def get_site_stats():
+    """返回帖子、评论、用户、版块总数及各版块帖子数，结果缓存SITE_STATS_TTL秒"""
+    return stats_cache.get_or_load('site', _load_site_stats)
+
+def invalidate_site_stats():
+    stats_cache.delete('site')
@@ -0,0 +1,13 @@
+import os
+
+# 只使用内存数据库，不读写实际的数据库文件
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import create_app
+from query_plans import check_fixture_query_plans
+
+def test_hot_queries_use_expected_indexes():
+    app = create_app()
+    with app.app_context():
+        failures = {check.name: (problems, plan) for check, plan, problems in check_fixture_query_plans() if problems}
+    assert not failures
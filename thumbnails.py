@@ -0,0 +1,115 @@
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from attachments import attachment_storage
+
+# 允许请求的缩略图尺寸（最长边，像素）
+THUMBNAIL_SIZES = (160, 320, 800)
+# 生成失败的缩略图在该秒数内不再重试，最多记录的失败数
+FAILED_RETRY_SECONDS = 600
+FAILED_MAX_ENTRIES = 10000
+
+class ThumbnailGenerator:
+    """图片附件的缩略图在第一次请求时由线程池生成并保存到磁盘，之后直接读取文件；
+    同一缩略图同时被多次请求时只生成一次"""
+
+    def __init__(self):
+        self.folder = None
+        self.workers = 2
+        self.timeout = 30
+        self.generated = 0
+        self._executor = None
+        self._running = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        upload_folder = app.config.get('UPLOAD_FOLDER', os.path.join(app.root_path, 'uploads'))
+        self.folder = os.path.join(upload_folder, 'thumbnails')
+        self.workers = app.config.get('THUMBNAIL_WORKERS', 2)
+        self.timeout = app.config.get('THUMBNAIL_TIMEOUT', 30)
+
+        if self._executor is None:
+            # 线程数即同时生成缩略图的上限，其余请求排队等待
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='thumbnail')
+            atexit.register(self.shutdown)
+
+    def path(self, content_hash, size):
+        # 按内容哈希保存，内容相同的附件共用缩略图
+        return os.path.join(self.folder, content_hash[:2], f'{content_hash}-{size}.webp')
+
+    def get(self, attachment, size):
+        """返回缩略图文件路径，尚未生成时等待生成完成；不是图片或无法解码时返回None，
+        等待超时时抛出concurrent.futures.TimeoutError"""
+        path = self.path(attachment.content_hash, size)
+        if os.path.exists(path):
+            return path
+
+        key = (attachment.content_hash, size)
+        source = attachment_storage.path(attachment)
+        with self._lock:
+            # 无法解码的文件在一段时间内不再重复尝试
+            if self._failed.get(key, 0) > time.monotonic():
+                return None
+            future = self._running.get(key)
+            submitted = future is None
+            if submitted:
+                future = self._executor.submit(self._generate, source, path, size)
+                self._running[key] = future
+        if submitted:
+            future.add_done_callback(lambda _: self._finish(key))
+        return path if future.result(self.timeout) else None
+
+    def _finish(self, key):
+        with self._lock:
+            future = self._running.pop(key, None)
+            if future is not None and not future.result():
+                now = time.monotonic()
+                self._failed.pop(key, None)
+                self._failed[key] = now + FAILED_RETRY_SECONDS
+                # 按失败时间顺序保存，清理过期记录，超出上限时丢弃最早的记录
+                for old_key, expires in list(self._failed.items()):
+                    if expires > now and len(self._failed) <= FAILED_MAX_ENTRIES:
+                        break
+                    del self._failed[old_key]
+
+    def _generate(self, source, path, size):
+        from PIL import Image, ImageOps
+        try:
+            with Image.open(source) as image:
+                # JPEG按目标尺寸缩小解码，动图只取第一帧
+                image.draft('RGB', (size, size))
+                image = ImageOps.exif_transpose(image)
+                image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+            # 保持比例缩小，小图不放大
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            # 先写临时文件再重命名，不会读到写了一半的图片
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            image.save(temp_path, 'WEBP', quality=80, method=4)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"缩略图生成失败: {source}: {str(e)}")
+            return False
+        self.generated += 1
+        return True
+
+    def remove(self, content_hash):
+        """删除附件文件时一并删除它的缩略图"""
+        with self._lock:
+            self._failed = {key: expires for key, expires in self._failed.items() if key[0] != content_hash}
+        for size in THUMBNAIL_SIZES:
+            try:
+                os.remove(self.path(content_hash, size))
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+thumbnail_generator = ThumbnailGenerator()
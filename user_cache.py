@@ -0,0 +1,106 @@
+from collections import namedtuple
+from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from cache import TTLCache
+from extensions import db
+from models import User
+
+# 模板和权限检查常用的用户字段，其余属性访问时再从数据库加载完整的User
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'user_id', 'username', 'email', 'avatar', 'bio', 'is_admin', 'created_at'])
+
+user_cache = TTLCache(ttl=30, maxsize=10000)
+
+def init_app(app):
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', 30)
+    user_cache.maxsize = app.config.get('USER_CACHE_SIZE', 10000)
+
+    # 任何代码路径修改或删除User后，提交时使本进程中的快照失效
+    if not event.contains(db.session, 'before_flush', _collect_changed_users):
+        event.listen(db.session, 'before_flush', _collect_changed_users)
+        event.listen(db.session, 'after_commit', _invalidate_changed_users)
+        event.listen(db.session, 'after_transaction_end', _discard_changed_users)
+
+class CachedUser(UserMixin):
+    """Flask-Login使用的当前用户，常用字段来自缓存的快照；
+    访问其他属性、调用方法或修改字段时加载本次请求会话中的User，之后的读写都使用该对象"""
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+
+    # 只用到用户ID的查询方法，直接使用，不需要加载User
+    get_post_vote = User.get_post_vote
+    get_comment_vote = User.get_comment_vote
+
+    @property
+    def id(self):
+        return self._snapshot.id
+
+    def load(self):
+        """返回当前请求会话中的User对象"""
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self._snapshot.id))
+        return self._user
+
+    def __getattr__(self, name):
+        # 快照中的管理员权限可能已在其他进程中被撤销，为真时以数据库为准
+        if name == 'is_admin' and self._snapshot.is_admin:
+            return self.load().is_admin
+        if self._user is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (CachedUser, User)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<CachedUser {self._snapshot.username}>'
+
+def _snapshot(user_id):
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    return UserSnapshot(*(getattr(user, field) for field in UserSnapshot._fields))
+
+def load_user(user_id):
+    """Flask-Login的user_loader，快照缓存USER_CACHE_TTL秒"""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    snapshot = user_cache.get_or_load(user_id, lambda: _snapshot(user_id))
+    return CachedUser(snapshot) if snapshot is not None else None
+
+def invalidate_user(user_id):
+    user_cache.delete(user_id)
+
+def _collect_changed_users(session, flush_context, instances):
+    changed = session.info.setdefault('changed_user_ids', set())
+    for user in session.deleted:
+        if isinstance(user, User):
+            changed.add(user.id)
+    for user in session.dirty:
+        if isinstance(user, User):
+            state = inspect(user)
+            if any(state.attrs[field].history.has_changes() for field in UserSnapshot._fields):
+                changed.add(user.id)
+
+def _invalidate_changed_users(session):
+    # 释放保存点时也会触发after_commit，只处理顶层事务的提交
+    if session.in_nested_transaction():
+        return
+    for user_id in session.info.pop('changed_user_ids', ()):
+        invalidate_user(user_id)
+
+def _discard_changed_users(session, transaction):
+    # 回滚时修改未生效，快照仍然有效
+    if transaction.parent is None:
+        session.info.pop('changed_user_ids', None)
@@ -0,0 +1,128 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from extensions import db
+from models import Post
+
+# 未启用后台线程时，去重记录超过该数量后清理一次过期记录
+SEEN_PRUNE_SIZE = 10000
+
+class ViewCounter:
+    """在内存中累计帖子浏览量，由后台线程定期合并为批量UPDATE写入，阅读帖子不再占用写锁"""
+
+    def __init__(self):
+        self.engine = None
+        self.flush_interval = 5.0
+        self.dedup_seconds = 0
+        self.flushed = 0
+        self._pending = defaultdict(int)
+        self._seen = {}
+        self._prune_at = SEEN_PRUNE_SIZE
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self._atexit_registered = False
+
+    def init_app(self, app):
+        self.flush_interval = app.config.get('VIEW_COUNT_FLUSH_INTERVAL', 5.0)
+        self.dedup_seconds = app.config.get('VIEW_COUNT_DEDUP_SECONDS', 0)
+
+        with app.app_context():
+            self.engine = db.engine
+
+    def _ensure_started(self):
+        # 调用方持有self._lock；第一次记录浏览时才启动后台线程，命令行等不处理请求的进程不会启动
+        if self._thread is not None:
+            return True
+        if self._stopped or self.flush_interval <= 0:
+            return False
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            # 进程退出前写入尚未保存的浏览量
+            atexit.register(self.stop)
+            self._atexit_registered = True
+        return True
+
+    def record(self, post_id, viewer=None):
+        """记录一次浏览；viewer为访客标识（用户ID或IP），去重窗口内重复浏览不计数"""
+        now = time.monotonic()
+        with self._lock:
+            if self.dedup_seconds > 0 and viewer is not None:
+                key = (viewer, post_id)
+                if self._seen.get(key, 0) > now:
+                    return
+                self._seen[key] = now + self.dedup_seconds
+            if self._ensure_started():
+                self._pending[post_id] += 1
+                return
+            # 没有后台线程调用flush，在这里清理过期的去重记录；清理后仍然很多时推迟下次清理，避免每次浏览都遍历
+            if len(self._seen) > self._prune_at:
+                self._prune_seen(now)
+                self._prune_at = max(SEEN_PRUNE_SIZE, 2 * len(self._seen))
+
+        # 未启用后台线程时在请求的会话中立即写入
+        db.session.execute(self._update_statement(), [{'b_id': post_id, 'b_count': 1}])
+        db.session.commit()
+
+    def pending(self, post_id):
+        # 尚未写入数据库的浏览量，用于页面显示
+        with self._lock:
+            return self._pending.get(post_id, 0)
+
+    def _update_statement(self):
+        table = Post.__table__
+        # 浏览量变化不算作编辑，保持updated_at不变
+        return table.update().where(table.c.id == db.bindparam('b_id')).values(
+            view_count=db.func.coalesce(table.c.view_count, 0) + db.bindparam('b_count'),
+            updated_at=table.c.updated_at
+        )
+
+    def stop(self, timeout=10):
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread is not None:
+            self._stop_event.set()
+            thread.join(timeout)
+            with self._lock:
+                self._thread = None
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(int)
+            # 顺便清理已过期的去重记录
+            self._prune_seen(time.monotonic())
+        if not pending:
+            return 0
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self._update_statement(), [{'b_id': post_id, 'b_count': count} for post_id, count in pending.items()])
+        except Exception as e:
+            # 写入失败时放回队列，下次再试
+            with self._lock:
+                for post_id, count in pending.items():
+                    self._pending[post_id] += count
+            print(f"浏览量写入失败: {str(e)}")
+            return 0
+
+        total = sum(pending.values())
+        self.flushed += total
+        return total
+
+    def _prune_seen(self, now):
+        # 调用方持有self._lock
+        if self._seen:
+            self._seen = {key: expires for key, expires in self._seen.items() if expires > now}
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+view_counter = ViewCounter()